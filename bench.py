@@ -0,0 +1,184 @@
+# Benchmark Nate on scripted conversations, live (recording fixtures) or offline from fixtures
+#
+#   python bench.py benchmarks/horned_lizard.json --record   # needs API_KEY and network
+#   python bench.py benchmarks/horned_lizard.json            # offline replay
+#
+# A script is a JSON file {"turns": ["user message", ...]}. Its fixtures are kept in a
+# directory next to it with the same name (benchmarks/horned_lizard/).
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+import checkpoints
+import inat_client
+import places
+import plotting
+import taxonomy
+import tracing
+from inat_cache import ResponseCache
+from llm import LLM
+from nate import Nate, TOOLS
+from replay import HTTP_FIXTURE, LLM_FIXTURE, FixtureServer, HTTPRecorder, RecordingLLM, ReplayLLM
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run a scripted conversation through Nate and report where the time went.")
+    parser.add_argument('script', type=str, help='JSON file with a list of user turns')
+    parser.add_argument('--record', action='store_true', help='Use the live model and API, saving fixtures for replay')
+    parser.add_argument('--stream', action='store_true', help='Drive Nate through the async streaming loop')
+    parser.add_argument('--out', type=str, default=None, help='Also write the report to this file')
+    return parser.parse_args()
+
+
+class MeteredLLM:
+    """ Passes calls through to an LLM, adding up tokens and time spent waiting on it """
+
+    def __init__(self, llm):
+        self.llm = llm
+        self.calls = 0
+        self.seconds = 0.0
+        self.tokens = {"input_tokens": 0, "output_tokens": 0}
+
+    def add_usage(self, usage):
+        self.calls += 1
+        for key in self.tokens:
+            self.tokens[key] += usage.get(key) or 0
+
+    def call(self, contents):
+        start = time.perf_counter()
+        content, usage = self.llm.call(contents)
+        self.seconds += time.perf_counter() - start
+        self.add_usage(usage)
+        return content, usage
+
+    async def call_stream(self, contents, usage=None):
+        usage = {} if usage is None else usage
+        start = time.perf_counter()
+        async for part in self.llm.call_stream(contents, usage):
+            yield part
+        self.seconds += time.perf_counter() - start
+        self.add_usage(usage)
+
+    def count_tokens(self, contents):
+        return self.llm.count_tokens(contents)
+
+
+class BenchNate(Nate):
+    """ Nate that times every tool call """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tool_times = {}
+        self.tool_lock = threading.Lock()
+
+    def run_tool(self, function_call):
+        start = time.perf_counter()
+        try:
+            return super().run_tool(function_call)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.tool_lock:
+                entry = self.tool_times.setdefault(function_call.name, {"calls": 0, "seconds": 0.0})
+                entry["calls"] += 1
+                entry["seconds"] += elapsed
+
+
+def isolate_caches(tmp_dir, replaying):
+    """ Points the response cache, taxonomy and place caches, checkpoints and plots at a scratch
+    directory so every run starts cold """
+    inat_client._cache = ResponseCache(path=os.path.join(tmp_dir, "responses.sqlite"))
+    taxonomy._index = taxonomy.TaxonomyIndex(os.path.join(tmp_dir, "taxonomy.sqlite"))
+    places._cache = places.PlaceCache(os.path.join(tmp_dir, "places.sqlite"))
+    checkpoints.CHECKPOINT_DIR = os.path.join(tmp_dir, "checkpoints")
+    # Plots are written to files rather than opened, so the benchmark measures building them
+    plotting.configure(os.path.join(tmp_dir, "plots"))
+    if replaying:
+        # Nothing to be polite to when the API is a local stand-in
+        inat_client._limiter = inat_client.TokenBucket(1e9, 1e9)
+
+
+def fixture_dir_of(script_path):
+    return os.path.splitext(script_path)[0]
+
+
+def missing_fixtures(script_path):
+    """ Returns the paths of the fixture files a replay of script_path needs but doesn't have """
+    fixture_dir = fixture_dir_of(script_path)
+    paths = [os.path.join(fixture_dir, name) for name in (LLM_FIXTURE, HTTP_FIXTURE)]
+    return [path for path in paths if not os.path.exists(path)]
+
+
+def run(script_path, record=False, stream=False):
+    with open(script_path, 'r') as f:
+        script = json.load(f)
+    fixture_dir = fixture_dir_of(script_path)
+    if record:
+        os.makedirs(fixture_dir, exist_ok=True)
+
+    tool_declarations = [tool.get_declaration() for tool in TOOLS]
+    if record:
+        llm = RecordingLLM(LLM(os.getenv("API_KEY"), tools=tool_declarations), fixture_dir)
+        inat_client.recorder = HTTPRecorder(fixture_dir)
+    else:
+        llm = ReplayLLM(fixture_dir)
+    llm = MeteredLLM(llm)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        isolate_caches(tmp_dir, replaying=not record)
+        server = None if record else FixtureServer(fixture_dir).__enter__()
+        if server is not None:
+            inat_client.API_ROOT = server.url
+        try:
+            nate = BenchNate(None, "prompt.txt", tools=TOOLS, llm=llm)
+            turn_seconds = []
+            start = time.perf_counter()
+            for turn in script["turns"]:
+                turn_start = time.perf_counter()
+                nate.add_msg("user", turn)
+                with tracing.span("turn"):
+                    if stream:
+                        asyncio.run(nate.acall())
+                    else:
+                        nate.call()
+                turn_seconds.append(time.perf_counter() - turn_start)
+            wall = time.perf_counter() - start
+        finally:
+            if server is not None:
+                server.__exit__(None, None, None)
+
+    return {
+        "script": script_path,
+        "mode": "record" if record else "replay",
+        "wall_seconds": round(wall, 3),
+        "turn_seconds": [round(t, 3) for t in turn_seconds],
+        "llm": {"calls": llm.calls, "seconds": round(llm.seconds, 3), **llm.tokens},
+        "tools": {name: {"calls": t["calls"], "seconds": round(t["seconds"], 3)} for name, t in nate.tool_times.items()},
+        "http": dict(inat_client.stats),
+        "objects": nate.objs.stats(),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main(args):
+    missing = [] if args.record else missing_fixtures(args.script)
+    if missing:
+        sys.exit(f"No recorded fixtures for {args.script} (missing {', '.join(missing)}).\n"
+                 f"Record them first with: python bench.py {args.script} --record")
+    report = run(args.script, record=args.record, stream=args.stream)
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main(parse_args())
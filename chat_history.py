@@ -0,0 +1,135 @@
+# Chat history that stays within a token budget
+
+import json
+
+from google.genai import types
+
+DEFAULT_TOKEN_BUDGET = 32000
+CHARS_PER_TOKEN = 4.0  # starting guess, corrected from the usage the model reports
+KEEP_RECENT_TURNS = 2  # user turns whose tool responses are never truncated
+TRUNCATED_RESPONSE_CHARS = 300
+
+
+class ChatHistory:
+    """ The conversation sent to the model on every call.
+
+    The first `n_pinned` messages (the system prompt and its acknowledgement)
+    are always sent, with a summary of the current data objects added to the
+    system prompt. When the rest grows past the token budget, function
+    responses from older turns are cut down first, then the oldest turns are
+    dropped whole.
+    """
+
+    def __init__(self, token_budget=DEFAULT_TOKEN_BUDGET, n_pinned=2, count_tokens=None):
+        self.messages = []
+        self.token_budget = token_budget
+        self.n_pinned = n_pinned
+        # Optional exact counter, e.g. LLM.count_tokens; costs a request per call
+        self.count_tokens = count_tokens
+        self.chars_per_token = CHARS_PER_TOKEN
+        # Characters sent with every call besides the messages, e.g. the tool declarations
+        self.overhead_chars = 0
+        self.sent_chars = None
+
+    def append(self, message):
+        self.messages.append(message)
+
+    def contents(self, objs=None):
+        """ Returns the messages to send, compacting the stored history first if it is over budget """
+        self.compact()
+        pinned = list(self.messages[:self.n_pinned])
+        if objs and pinned:
+            summaries = "\n".join(obj.get_summary() for obj in objs.values())
+            pinned[0] = {'role': pinned[0]['role'], 'parts': [{'text': message_text(pinned[0]) +
+                         "\n\nYou have access to the following data objects:\n" + summaries + "\n"}]}
+        messages = pinned + self.messages[self.n_pinned:]
+        self.sent_chars = sum(message_chars(m) for m in messages) + self.overhead_chars
+        return messages
+
+    def record_usage(self, usage):
+        """ Calibrates the local estimate against the input token count the model reported
+        for the last contents() sent """
+        if usage and usage.get("input_tokens") and self.sent_chars:
+            self.chars_per_token = max(1.0, self.sent_chars / usage["input_tokens"])
+
+    def estimate_tokens(self, messages):
+        if self.count_tokens is not None:
+            return self.count_tokens(messages)
+        return int(sum(message_chars(m) for m in messages) / self.chars_per_token)
+
+    def compact(self):
+        tokens = self.estimate_tokens(self.messages)
+        if tokens > self.token_budget:
+            self.truncate_old_responses()
+            tokens = self.estimate_tokens(self.messages)
+        while tokens > self.token_budget and self.drop_oldest_turn():
+            tokens = self.estimate_tokens(self.messages)
+
+    def turn_starts(self):
+        """ Indexes of user text messages, i.e. where each turn of the conversation begins """
+        return [i for i in range(self.n_pinned, len(self.messages))
+                if role_of(self.messages[i]) == 'user' and message_text(self.messages[i])]
+
+    def truncate_old_responses(self):
+        starts = self.turn_starts()
+        if len(starts) <= KEEP_RECENT_TURNS:
+            return
+        for i in range(self.n_pinned, starts[-KEEP_RECENT_TURNS]):
+            self.messages[i] = truncate_function_responses(self.messages[i])
+
+    def drop_oldest_turn(self):
+        """ Removes the oldest whole turn, keeping the latest one. Returns False if there is nothing left to drop """
+        starts = self.turn_starts()
+        if len(starts) < 2:
+            return False
+        del self.messages[starts[0]:starts[1]]
+        return True
+
+
+def role_of(message):
+    return message['role'] if isinstance(message, dict) else message.role
+
+
+def parts_of(message):
+    return message['parts'] if isinstance(message, dict) else (message.parts or [])
+
+
+def message_text(message):
+    texts = []
+    for part in parts_of(message):
+        text = part.get('text') if isinstance(part, dict) else part.text
+        if text:
+            texts.append(text)
+    return "".join(texts)
+
+
+def message_chars(message):
+    chars = 0
+    for part in parts_of(message):
+        if isinstance(part, dict):
+            chars += len(json.dumps(part, default=str))
+        elif part.text is not None:
+            chars += len(part.text)
+        elif part.function_call is not None:
+            chars += len(part.function_call.name) + len(json.dumps(part.function_call.args, default=str))
+        elif part.function_response is not None:
+            chars += len(json.dumps(part.function_response.response, default=str))
+    return chars
+
+
+def truncate_function_responses(message):
+    """ Returns message with any long function response cut down to its first few hundred characters """
+    if isinstance(message, dict) or not any(part.function_response is not None for part in parts_of(message)):
+        return message
+    parts = []
+    for part in parts_of(message):
+        response = part.function_response
+        text = json.dumps(response.response, default=str) if response is not None else ""
+        if response is None or len(text) <= TRUNCATED_RESPONSE_CHARS:
+            parts.append(part)
+            continue
+        parts.append(types.Part.from_function_response(
+            name=response.name,
+            response={"result": text[:TRUNCATED_RESPONSE_CHARS] + " ...[truncated to save context]"},
+        ))
+    return types.Content(role=message.role, parts=parts)
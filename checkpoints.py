@@ -0,0 +1,95 @@
+# On-disk checkpoints so long observation pulls can resume after a failure
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import threading
+import time
+
+from inat_cache import CACHE_DIR, normalize_params
+
+CHECKPOINT_DIR = os.path.join(CACHE_DIR, "checkpoints")
+MAX_AGE = 7 * 24 * 3600  # older progress is thrown away rather than resumed
+
+
+class Checkpoint:
+    """ Progress of one fetch_observations call: the first page, the id slices the
+    rest was split into, and every page each slice has finished so far.
+
+    state.json holds the plan and each slice's cursor. Pages are pickled next to it,
+    so a resumed call only fetches what is still missing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {}
+        state_path = os.path.join(path, "state.json")
+        if os.path.exists(state_path) and time.time() - os.path.getmtime(state_path) > MAX_AGE:
+            self.clear()
+        elif os.path.exists(state_path):
+            with open(state_path, 'r') as f:
+                self.state = json.load(f)
+
+    @classmethod
+    def for_query(cls, params, n=None):
+        """ Returns the checkpoint for a query, which may already hold progress from an earlier call """
+        key = json.dumps([normalize_params(params), n])
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return cls(os.path.join(CHECKPOINT_DIR, digest))
+
+    def save_first(self, chunk, count, total, hi):
+        self.write_chunk("first", chunk)
+        with self.lock:
+            self.state.update({'first_count': count, 'total': total, 'hi': hi})
+            self.write_state()
+
+    def load_first(self):
+        return self.read_chunk("first")
+
+    def save_plan(self, slices):
+        with self.lock:
+            self.state['slices'] = [list(s) for s in slices]
+            self.state['progress'] = {}
+            self.write_state()
+
+    def save_page(self, slice_index, chunk, count, id_below, done):
+        """ Records one finished page of a slice, and where that slice's cursor now stands """
+        with self.lock:
+            progress = self.state['progress'].setdefault(str(slice_index), {'pages': 0, 'count': 0})
+            self.write_chunk(f"slice{slice_index}_{progress['pages']:06d}", chunk)
+            progress['pages'] += 1
+            progress['count'] += count
+            progress['id_below'] = id_below
+            progress['done'] = done
+            self.write_state()
+
+    def load_slice(self, slice_index):
+        """ Returns (pages, count, id_below, done) saved so far for a slice """
+        progress = self.state.get('progress', {}).get(str(slice_index))
+        if progress is None:
+            return [], 0, None, False
+        chunks = [self.read_chunk(f"slice{slice_index}_{page:06d}") for page in range(progress['pages'])]
+        return chunks, progress['count'], progress['id_below'], progress['done']
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.state = {}
+
+    def write_state(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = os.path.join(self.path, "state.json.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, os.path.join(self.path, "state.json"))
+
+    def write_chunk(self, name, chunk):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, name + ".pkl"), 'wb') as f:
+            pickle.dump(chunk, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def read_chunk(self, name):
+        with open(os.path.join(self.path, name + ".pkl"), 'rb') as f:
+            return pickle.load(f)
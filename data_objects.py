@@ -1,5 +1,16 @@
+import json
+import os
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import feather
+
+from observation_parser import attribution, DERIVED_COLUMN_INPUTS
+from spatial import SpatialIndex
+
+ARROW_META_KEY = b'nate'  # Arrow schema metadata holding a frame's row count and columns
 
 class DataObject:
     def __init__(self, name, data):
@@ -8,19 +19,201 @@ class DataObject:
 
 
 class DataFrame(DataObject):
+    # Columns computed on demand from the stored ones: name -> (function(pandas DataFrame) -> Series, input columns)
+    derived_columns = {}
+
     def __init__(self, name, data):
         assert type(name) == str, "DataFrame name must be a string"
         assert isinstance(data, pd.DataFrame), "DataFrame data must be a pandas DataFrame"
+        self.store = None  # the ObjectStore holding this frame, which may spill it to disk
+        self.arrow_path = None  # Arrow file holding a copy of the data, if one has been written
+        self.owns_arrow = False  # False when the file belongs to a snapshot and must outlive the frame
+        self.arrow_rows = None  # kept for the summary while the data is only on disk
+        self.arrow_columns = None
         super().__init__(name, data)
 
+    @property
+    def data(self):
+        store = self.store
+        if store is not None:
+            return store.touch(self)
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self.indexes = {}  # column(s) -> ListIndex or SpatialIndex, built on first use and kept while the data is
+
+    def is_loaded(self):
+        return self._data is not None
+
+    def n_rows(self):
+        return len(self._data) if self._data is not None else self.arrow_rows
+
+    def stored_columns(self):
+        return list(self._data.columns) if self._data is not None else list(self.arrow_columns)
+
+    def column_names(self):
+        """ Returns the stored columns followed by any derived ones that can be computed from them """
+        stored = self.stored_columns()
+        derived = [col for col, (_, inputs) in self.derived_columns.items()
+                   if col not in stored and set(inputs) <= set(stored)]
+        return stored + derived
+
+    def list_index(self, column):
+        """ Returns the ListIndex of a stored list column, building it the first time it's asked for """
+        if column not in self.indexes:
+            self.indexes[column] = ListIndex.from_series(self.data[column])
+        return self.indexes[column]
+
+    def spatial_index(self):
+        """ Returns the SpatialIndex of the latitude and longitude columns, building it the first time it's asked for """
+        key = ('latitude', 'longitude')
+        if key not in self.indexes:
+            if not set(key) <= set(self.stored_columns()):
+                raise ValueError(f"{self.name} has no latitude and longitude columns")
+            data = self.data
+            self.indexes[key] = SpatialIndex(data['latitude'].to_numpy(dtype=float, na_value=np.nan),
+                                             data['longitude'].to_numpy(dtype=float, na_value=np.nan))
+        return self.indexes[key]
+
+    def nbytes(self):
+        return int(self._data.memory_usage(deep=True).sum())
+
+    def write_arrow(self, path):
+        """ Writes the data to an uncompressed Arrow file, with the row count and column
+        names in the file's metadata so a summary never has to read the data """
+        table = pa.Table.from_pandas(self._data)
+        meta = {
+            'rows': len(self._data),
+            'columns': [str(col) for col in self._data.columns],
+            'arrow_columns': [col for col, dtype in self._data.dtypes.items() if isinstance(dtype, pd.ArrowDtype)],
+        }
+        table = table.replace_schema_metadata({**table.schema.metadata, ARROW_META_KEY: json.dumps(meta).encode()})
+        # Written beside the target and moved over it, so readers that have the old file mapped are unaffected
+        tmp_path = path + ".tmp"
+        feather.write_feather(table, tmp_path, compression='uncompressed')
+        os.replace(tmp_path, path)
+
+    def attach_arrow(self, path, owned=True):
+        """ Points the frame at an Arrow file written by write_arrow and drops the data from memory """
+        with pa.memory_map(path) as source:
+            meta = json.loads(pa.ipc.open_file(source).schema.metadata[ARROW_META_KEY])
+        self.arrow_path = path
+        self.owns_arrow = owned
+        self.arrow_rows = meta['rows']
+        self.arrow_columns = meta['columns']
+        self.data = None  # through the setter, so indexes built over the data go with it
+
+    def spill(self, path):
+        """ Writes the data to an Arrow file at path (unless a copy is already on disk) and drops it from memory """
+        # Tools never change a stored frame in place, so a file from an earlier spill or snapshot is still current
+        if self.arrow_path is None:
+            self.write_arrow(path)
+            self.attach_arrow(path)
+        else:
+            self.data = None
+
+    def load(self):
+        """ Reads the data back from its Arrow file, memory-mapping it """
+        table = feather.read_table(self.arrow_path, memory_map=True)
+        meta = json.loads(table.schema.metadata[ARROW_META_KEY])
+        # pyarrow can't rebuild Arrow-backed columns from the pandas metadata, so they are mapped by type and rewrapped
+        df = table.to_pandas(types_mapper=lambda t: pd.ArrowDtype(t) if pa.types.is_list(t) else None)
+        for col in meta['arrow_columns']:
+            df[col] = pd.arrays.ArrowExtensionArray(table.column(col))
+        self._data = df
+
+    def discard_spill(self):
+        """ Deletes the spill file once the frame has left its store """
+        if self.arrow_path is not None and self.owns_arrow:
+            os.remove(self.arrow_path)
+        self.arrow_path = None
+
+    def snapshot_metadata(self):
+        """ Extra constructor arguments needed to rebuild this frame from a snapshot """
+        return {}
+
+    def with_columns(self, df, cols):
+        """ Returns df (rows of self.data) with any derived columns named in cols added """
+        derived = [col for col in cols if col in self.derived_columns and col not in df.columns]
+        if not derived:
+            return df
+        return df.assign(**{col: self.derived_columns[col][0](df) for col in derived})
+
     def get_summary(self):
         """ Returns a string with a summary of the dataframe """
-        output = (f"{self.name} is a pandas DataFrame with {len(self.data)} rows " +
+        output = (f"{self.name} is a pandas DataFrame with {self.n_rows()} rows " +
                 "and the following columns: " +
-                str([col for col in self.data.columns])) 
+                str(self.column_names()))
         return output
 
 
 
+class ListIndex:
+    """ Inverted index of a list column (such as place_ids), from each value to the rows
+    whose list holds it, kept as CSR arrays: rows[indptr[i]:indptr[i + 1]] are the rows
+    holding keys[i], in order. Finding the rows for a value is one binary search. """
+
+    def __init__(self, keys, indptr, rows, n_rows):
+        self.keys = keys
+        self.indptr = indptr
+        self.rows = rows
+        self.n_rows = n_rows
+
+    @classmethod
+    def from_series(cls, series):
+        if isinstance(series.dtype, pd.ArrowDtype):
+            lists = pa.array(series.array)
+        elif series.dtype != object:
+            raise ValueError(f"Column '{series.name}' does not hold lists")
+        else:
+            lists = pa.array([value if isinstance(value, (list, tuple, np.ndarray)) else None for value in series])
+        if isinstance(lists, pa.ChunkedArray):
+            lists = lists.combine_chunks()
+        if not pa.types.is_list(lists.type):
+            raise ValueError(f"Column '{series.name}' does not hold lists")
+        values = pc.list_flatten(lists).to_numpy(zero_copy_only=False)
+        parents = pc.list_parent_indices(lists).to_numpy(zero_copy_only=False)
+        order = np.argsort(values, kind='stable')
+        keys, starts = np.unique(values[order], return_index=True)
+        row_type = np.int32 if len(series) < 2 ** 31 else np.int64
+        return cls(keys, np.append(starts, len(values)), parents[order].astype(row_type), len(series))
+
+    def rows_with(self, value):
+        """ Returns the positions of the rows whose list holds value """
+        i = np.searchsorted(self.keys, value)
+        if i == len(self.keys) or self.keys[i] != value:
+            return self.rows[:0]
+        return self.rows[self.indptr[i]:self.indptr[i + 1]]
+
+    def mask(self, value):
+        """ Returns a boolean numpy mask of the rows whose list holds value """
+        mask = np.zeros(self.n_rows, dtype=bool)
+        mask[self.rows_with(value)] = True
+        return mask
+
+
+class ObservationDataFrame(DataFrame):
+    """ DataFrame of individual observations that remembers the query that built it,
+    so it can later be refreshed with only the observations that changed """
+
+    derived_columns = {'attribution': (attribution, DERIVED_COLUMN_INPUTS['attribution'])}
+
+    def __init__(self, name, data, query, n=None):
+        super().__init__(name, data)
+        self.query = dict(query) if query is not None else None  # None when built from several queries
+        self.n = n
 
+    def snapshot_metadata(self):
+        return {'query': self.query, 'n': self.n}
 
+    def high_water_mark(self):
+        """ Returns (latest updated_at, largest observation_id), either of which may be None """
+        updated_at = None
+        if 'updated_at' in self.data.columns and self.data['updated_at'].notna().any():
+            updated_at = self.data['updated_at'].max()
+        observation_id = None
+        if len(self.data) > 0:
+            observation_id = int(self.data['observation_id'].max())
+        return updated_at, observation_id
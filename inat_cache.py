@@ -0,0 +1,144 @@
+# Persistent on-disk cache for iNaturalist API responses
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_DIR = os.path.expanduser(os.getenv("NATE_CACHE_DIR", "~/.cache/nate"))
+MAX_BYTES = 256 * 1024 * 1024
+SWEEP_EVERY = 200  # writes between sweeps for expired entries (and recounts of the total size)
+ACCESS_FLUSH = 100  # cache hits whose access times are held before being written together
+
+# Seconds a response stays fresh, matched on the longest endpoint prefix
+DEFAULT_TTLS = {
+    "/taxa": 7 * 24 * 3600,
+    "/places": 30 * 24 * 3600,
+    "/observations/species_counts": 24 * 3600,
+    "/observations": 3600,
+    "/v2/observations": 3600,
+    "": 3600,
+}
+
+
+def normalize_params(params):
+    """ Returns params as a sorted list of (key, str value) pairs, dropping Nones """
+    normalized = []
+    for key, value in (params or {}).items():
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            value = ",".join(str(v) for v in value)
+        elif isinstance(value, bool):
+            value = str(value).lower()
+        normalized.append((key, str(value)))
+    return sorted(normalized)
+
+
+class ResponseCache:
+    """ SQLite-backed JSON cache keyed on endpoint + params, with per-endpoint TTLs and LRU eviction.
+
+    The total size is kept as a running count rather than summed on every write,
+    and the access times of hits are written in batches, so neither a hit nor a
+    write scans the table or commits just for bookkeeping. Expired entries are
+    swept every SWEEP_EVERY writes, or whenever the cache goes over max_bytes.
+    """
+
+    def __init__(self, path=None, max_bytes=MAX_BYTES, ttls=None):
+        if path is None:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            path = os.path.join(CACHE_DIR, "responses.sqlite")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, endpoint TEXT, body TEXT, size INTEGER, "
+            "expires_at REAL, accessed_at REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        self.conn.commit()
+        self.total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.writes = 0
+        self.accessed = {}  # key -> access time of hits not yet written
+
+    def make_key(self, endpoint, params):
+        return endpoint + "?" + "&".join(f"{k}={v}" for k, v in normalize_params(params))
+
+    def ttl(self, endpoint):
+        prefix = max((p for p in self.ttls if endpoint.startswith(p)), key=len)
+        return self.ttls[prefix]
+
+    def get(self, endpoint, params):
+        """ Returns the cached response, or None on a miss or an expired entry """
+        key = self.make_key(endpoint, params)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT body, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] < now:
+                self.misses += 1
+                return None
+            self.accessed[key] = now
+            if len(self.accessed) >= ACCESS_FLUSH:
+                self.flush_accessed()
+                self.conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, endpoint, params, value):
+        key = self.make_key(endpoint, params)
+        body = json.dumps(value)
+        now = time.time()
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, endpoint, body, len(body), now + self.ttl(endpoint), now),
+            )
+            self.total += len(body) - (old[0] if old else 0)
+            self.writes += 1
+            if self.total > self.max_bytes or self.writes % SWEEP_EVERY == 0:
+                self.evict()
+            self.conn.commit()
+
+    def flush_accessed(self):
+        """ Writes the access times of recent hits; the caller commits """
+        self.conn.executemany("UPDATE responses SET accessed_at = ? WHERE key = ?",
+                              [(accessed_at, key) for key, accessed_at in self.accessed.items()])
+        self.accessed = {}
+
+    def evict(self):
+        """ Drops expired entries, then least recently used ones until under max_bytes """
+        # Eviction goes by access time, so the held ones are written first
+        self.flush_accessed()
+        self.conn.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+        # Recounted here, which also picks up writes from other processes sharing the file
+        self.total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if self.total <= self.max_bytes:
+            return
+        freed = 0
+        stale = []
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            stale.append((key,))
+            freed += size
+            if self.total - freed <= self.max_bytes:
+                break
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+        self.total -= freed
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM responses")
+            self.conn.commit()
+            self.total = 0
+            self.accessed = {}
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
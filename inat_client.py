@@ -0,0 +1,297 @@
+# Helpers for talking to the iNaturalist REST API
+
+import math
+import os
+import random
+import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+import tracing
+from inat_cache import ResponseCache
+
+# NATE_API_ROOT can point the tools at a local stand-in, e.g. replay.FixtureServer
+API_ROOT = os.getenv("NATE_API_ROOT", "https://api.inaturalist.org")
+OBSERVATIONS_PATH = "/v2/observations"  # v2 so responses can be limited to the fields we use
+PER_PAGE = 200  # largest page size /observations will return
+MAX_WORKERS = 4
+SLICES_PER_WORKER = 4  # more slices than workers so uneven id ranges still balance out
+MAX_CONCURRENT_REQUESTS = 8  # shared by every tool and worker pool in the process
+
+# iNaturalist asks clients to stay around 60 requests a minute
+REQUESTS_PER_SECOND = float(os.getenv("NATE_REQUESTS_PER_SECOND", "1"))
+BURST = 10
+MAX_RETRIES = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+
+class TokenBucket:
+    """ Thread-safe token bucket: take() blocks until a request may be sent """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """ Empties the bucket so nobody sends for roughly `seconds`, e.g. after a 429 """
+        with self.lock:
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+_session = None
+_session_lock = threading.Lock()
+_request_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+_limiter = TokenBucket(REQUESTS_PER_SECOND, BURST)
+
+# Network totals for this process, read by benchmarks
+stats = {"requests": 0, "bytes": 0}
+_stats_lock = threading.Lock()
+
+# Called as recorder(url, params, response) after every network response, e.g. replay.HTTPRecorder
+recorder = None
+
+
+def get_cache():
+    """ Returns the process-wide response cache, opening it on first use """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache
+
+
+def get_session():
+    """ Returns the process-wide keep-alive session that every API request goes through """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENT_REQUESTS)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+            _session.headers.update({"Accept-Encoding": "gzip", "User-Agent": "nate-inaturalist-agent"})
+        return _session
+
+
+def backoff_delay(attempt, response=None):
+    """ Seconds to wait before retry number `attempt`, honouring Retry-After when the API sends one """
+    if response is not None and response.headers.get("Retry-After", "").isdigit():
+        return float(response.headers["Retry-After"])
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def send(url, params=None, timeout=30):
+    """ GETs url through the shared session, rate limited, retrying 429/5xx and dropped connections """
+    for attempt in range(MAX_RETRIES + 1):
+        tracing.current().set(attempts=attempt + 1)
+        _limiter.take()
+        try:
+            with _request_slots:
+                response = get_session().get(url, params=params, timeout=timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt == MAX_RETRIES:
+                raise
+            time.sleep(backoff_delay(attempt))
+            continue
+        with _stats_lock:
+            stats["requests"] += 1
+            stats["bytes"] += len(response.content)
+        if recorder is not None:
+            recorder(url, params, response)
+        if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            return response
+        delay = backoff_delay(attempt, response)
+        if response.status_code == 429:
+            _limiter.pause(delay)
+        time.sleep(delay)
+
+
+def get_json(path, params=None, timeout=30, use_cache=True):
+    """ GETs an API path (e.g. '/taxa', or '/v2/...' for the v2 API) and returns the decoded JSON """
+    with tracing.span("http", path=path, cache="off") as span:
+        if use_cache:
+            cached = get_cache().get(path, params)
+            span.set(cache="hit" if cached is not None else "miss")
+            if cached is not None:
+                return cached
+        url = API_ROOT + path if path.startswith('/v2/') else API_ROOT + "/v1" + path
+        response = send(url, params=params, timeout=timeout)
+        span.set(status=response.status_code, bytes=len(response.content))
+        response.raise_for_status()
+        data = response.json()
+        if isinstance(data, dict) and 'results' in data:
+            span.set(rows=len(data['results']))
+        if use_cache:
+            get_cache().set(path, params, data)
+        return data
+
+
+def fetch_all_pages(path, params, per_page=500, workers=MAX_WORKERS):
+    """ Returns the results from every page of a page-numbered endpoint such as
+    /observations/species_counts. Pages after the first are fetched concurrently. """
+    first = get_json(path, dict(params, per_page=per_page, page=1))
+    results = first.get('results', [])
+    total = first.get('total_results', len(results))
+    n_pages = math.ceil(total / per_page)
+    if n_pages > 1:
+        print(f"Fetching {n_pages} pages of {path}...")
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            get_page = tracing.propagate(lambda page: get_json(path, dict(params, per_page=per_page, page=page)))
+            pages = pool.map(get_page, range(2, n_pages + 1))
+            for page in pages:
+                results.extend(page.get('results', []))
+    return results
+
+
+def fetch_observations(params, n=None, workers=MAX_WORKERS, use_cache=True, parse=None, checkpoint=None):
+    """ Returns every observation matching params, newest id first, up to n.
+
+    Pages are walked with an id_below cursor rather than page=, so the API's
+    10,000 result cap never applies. Once the first page shows how many
+    results there are, the remaining id range is split into slices that are
+    walked in parallel by a bounded pool of workers. A pull limited to n
+    walks on with a single cursor instead and stops at n.
+
+    If parse is given, each page is passed through it as soon as it arrives
+    and the list of parsed pages is returned instead, so the raw JSON never
+    has to be held all at once. The last parsed page may run past n.
+
+    If checkpoint is given, every finished page is saved to it, and progress
+    already in it is reused, so a call that failed part way can be repeated
+    without refetching. The checkpoint is cleared once the pull completes.
+    """
+    params = dict(params, order_by='id', order='desc')
+    per_page = min(PER_PAGE, n) if n else PER_PAGE
+    parse_page = parse if parse is not None else (lambda page: page)
+    state = checkpoint.state if checkpoint is not None else {}
+
+    if 'total' in state:
+        total, count, hi = state['total'], state['first_count'], state['hi']
+        chunks = [checkpoint.load_first()]
+        print(f"Resuming fetch of {total} observations from checkpoint...")
+    else:
+        first = get_json(OBSERVATIONS_PATH, dict(params, per_page=per_page), use_cache=use_cache)
+        observations = first.get('results', [])
+        total = first.get('total_results', len(observations))
+        if n:
+            total = min(total, n)
+        print(f"Fetching {total} observations...")
+        with tracing.span("parse", rows=len(observations[:total])):
+            chunks = [parse_page(observations[:total])]
+        count = len(observations)
+        hi = observations[-1]['id'] if observations else None
+        del first, observations
+        if checkpoint is not None:
+            checkpoint.save_first(chunks[0], count, total, hi)
+
+    if count < total and count == per_page:
+        if 'slices' in state:
+            slices = [tuple(s) for s in state['slices']]
+        elif n:
+            # A limited pull only needs the next few pages, so one cursor walks on down from the first page
+            slices = [(0, hi)]
+            if checkpoint is not None:
+                checkpoint.save_plan(slices)
+        else:
+            # Split what is left below the first page into independent id ranges
+            oldest = get_json(OBSERVATIONS_PATH, dict(params, order='asc', per_page=1, fields='(id:!t)'), use_cache=use_cache).get('results', [])
+            lo = oldest[0]['id'] if oldest else hi
+            remaining_pages = math.ceil((total - count) / PER_PAGE)
+            n_slices = max(1, min(remaining_pages, workers * SLICES_PER_WORKER, hi - lo))
+            slices = id_slices(lo, hi, n_slices) if oldest else []
+            if checkpoint is not None:
+                checkpoint.save_plan(slices)
+        print(f"Walking {len(slices)} id ranges with {workers} workers...")
+
+        pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            limit = total - count if n else None
+            futures = [pool.submit(tracing.propagate(resume_id_range), params, i, above, below, use_cache, parse_page, checkpoint, limit)
+                       for i, (above, below) in enumerate(slices)]
+            # Slices are in descending id order, so results stay newest first
+            for future in futures:
+                slice_chunks, slice_count = future.result()
+                chunks.extend(slice_chunks)
+                count += slice_count
+                if n and count >= n:
+                    break
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    if checkpoint is not None:
+        checkpoint.clear()
+    if parse is not None:
+        return chunks
+    results = [obs for chunk in chunks for obs in chunk]
+    return results[:n] if n else results
+
+
+def id_slices(lo, hi, n_slices):
+    """ Splits the ids in [lo, hi) into n_slices (id_above, id_below) pairs, highest first """
+    step = (hi - lo) / n_slices
+    edges = [hi] + [hi - round(step * i) for i in range(1, n_slices)] + [lo]
+    return [(edges[i + 1] - 1, edges[i]) for i in range(n_slices)]
+
+
+def resume_id_range(params, slice_index, id_above, id_below, use_cache=True, parse_page=None, checkpoint=None, limit=None):
+    """ walk_id_range for one slice of a checkpointed pull, starting after any pages already saved """
+    if checkpoint is None:
+        return walk_id_range(params, id_above, id_below, use_cache, parse_page, limit=limit)
+
+    chunks, count, cursor, done = checkpoint.load_slice(slice_index)
+    if done or (limit is not None and count >= limit):
+        return chunks, count
+
+    def on_page(chunk, page_count, next_id_below, last):
+        checkpoint.save_page(slice_index, chunk, page_count, next_id_below, last)
+
+    more_chunks, more_count = walk_id_range(params, id_above, cursor or id_below, use_cache, parse_page, on_page,
+                                            limit - count if limit is not None else None)
+    return chunks + more_chunks, count + more_count
+
+
+def walk_id_range(params, id_above, id_below, use_cache=True, parse_page=None, on_page=None, limit=None):
+    """ Walks all observations with id_above < id < id_below, following an id_below cursor,
+    stopping once limit observations have been fetched if a limit is given.
+
+    Returns (pages, count), where each page has been passed through parse_page if given.
+    on_page(page, count, next_id_below, last) is called after each page.
+    """
+    chunks = []
+    count = 0
+    while True:
+        per_page = PER_PAGE if limit is None else min(PER_PAGE, limit - count)
+        page = get_json(OBSERVATIONS_PATH, dict(params, id_above=id_above, id_below=id_below, per_page=per_page), use_cache=use_cache)
+        observations = page.get('results', [])
+        count += len(observations)
+        if observations:
+            id_below = observations[-1]['id']
+        with tracing.span("parse", rows=len(observations)):
+            chunk = parse_page(observations) if parse_page is not None else observations
+        chunks.append(chunk)
+        last = len(observations) < per_page or (limit is not None and count >= limit)
+        if on_page is not None:
+            on_page(chunk, len(observations), id_below, last)
+        if last:
+            return chunks, count
@@ -37,6 +37,29 @@ class LLM:
         }
         return content, usage
 
+    async def call_stream(self, contents, usage=None):
+        """ Async generator over the parts of a streamed response, yielded as they arrive.
+
+        Text arrives in pieces; each function call arrives whole in a single part.
+        If a usage dict is passed it is filled in from the stream's usage metadata.
+        """
+        stream = await self.client.aio.models.generate_content_stream(
+            model=self.model,
+            contents=contents,
+            config=self.config
+        )
+        async for chunk in stream:
+            if chunk.usage_metadata is not None and usage is not None:
+                usage.update({
+                    "input_tokens": chunk.usage_metadata.prompt_token_count,
+                    "output_tokens": chunk.usage_metadata.candidates_token_count,
+                    "total_tokens": chunk.usage_metadata.total_token_count
+                })
+            if not chunk.candidates or chunk.candidates[0].content is None:
+                continue
+            for part in chunk.candidates[0].content.parts or []:
+                yield part
+
     def count_tokens(self, contents):
         # returns int
         response = self.client.models.count_tokens(
@@ -2,35 +2,54 @@
 from google.genai import types
 import json
 from llm import LLM
+from chat_history import ChatHistory, DEFAULT_TOKEN_BUDGET
+from object_store import ObjectStore, MEMORY_BUDGET
+from snapshot import Snapshot
 import argparse
+import asyncio
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-from nate_tools import GetTaxonID, GetLocationID, GetObservationSummary, GetObservations, ReadDF, PlotHistogram, PlotXY
+import plotting
+import tracing
+
+from nate_tools import GetTaxonID, GetLocationID, GetObservationSummary, GetObservations, RefreshObservations, GetObservationSummaryBatch, GetObservationsBatch, QueryLocalObservations, ReadDF, AggregateDF, SpatialQueryDF, SpatialCountsDF, PlotHistogram, PlotXY
 
 # This is the code for actually running the agent
 
+MAX_PARALLEL_TOOLS = 8
+TOOLS = [GetTaxonID, GetLocationID, GetObservationSummary, GetObservations, RefreshObservations, GetObservationSummaryBatch, GetObservationsBatch, QueryLocalObservations, ReadDF, AggregateDF, SpatialQueryDF, SpatialCountsDF, PlotHistogram, PlotXY]
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="A simple script demonstrating store_true.")
     #parser.add_argument('', type=str, help='a string')
     parser.add_argument('--test', action='store_true', help='Load test datasets at init')
+    parser.add_argument('--no-stream', action='store_true', help='Wait for whole model responses instead of streaming them')
+    parser.add_argument('--token-budget', type=int, default=DEFAULT_TOKEN_BUDGET, help='Max tokens of chat history sent to the model per call')
+    parser.add_argument('--memory-budget', type=float, default=MEMORY_BUDGET / 2**20, help='MB of DataFrames kept in memory before older ones spill to disk')
+    parser.add_argument('--snapshot', type=str, default=None, help='Directory to restore data objects from at startup and save them to after every turn')
+    parser.add_argument('--restore-history', action='store_true', help='Also restore the chat from --snapshot')
+    parser.add_argument('--plot-dir', type=str, default=plotting.PLOT_DIR, help='Save plots to this directory instead of opening them in a browser')
+    parser.add_argument('--plot-format', choices=plotting.PLOT_FORMATS, default=plotting.PLOT_FORMAT, help='File type for --plot-dir; png needs the kaleido package')
+    parser.add_argument('--trace', type=str, default=tracing.TRACE_PATH, help='Append timing spans for every turn to this JSON lines file')
+    parser.add_argument('--profile', choices=tracing.PROFILES, default=tracing.PROFILE, help='Profile each tool call with cProfile (cpu) or tracemalloc (memory); needs --trace')
     return parser.parse_args()
 
 
 class Nate:
-    def __init__(self, api_key, system_prompt_path, tools=None, objs=None):
+    def __init__(self, api_key, system_prompt_path, tools=None, objs=None, token_budget=DEFAULT_TOKEN_BUDGET, llm=None, memory_budget=MEMORY_BUDGET):
         self.api_key = api_key
-        self.chat_hist = []
-        self.objs = {}
+        # Summaries of the data objects are added to the system prompt on every call
+        self.history = ChatHistory(token_budget=token_budget)
+        self.chat_hist = self.history.messages
+        # Data objects by name; least recently used ones spill to disk past the memory budget
+        self.objs = ObjectStore(budget=memory_budget)
         system_prompt = self.load_system_prompt(system_prompt_path)
         assert objs is None or type(objs) == dict, "objs must be None or dict"
         if objs is not None:
-            system_prompt += "\n\nYou have access to the following data objects:\n"
             for obj_name in objs:
-                system_prompt += objs[obj_name].get_summary() + "\n"
                 self.objs[obj_name] = objs[obj_name]
-        else:
-            self.objs = {}
 
         self.add_msg('user', system_prompt)
         self.add_msg('model', 'I understand the instructions, and I will act accordingly')
@@ -41,7 +60,10 @@ class Nate:
                 self.tools.append(tool.get_declaration())
                 self.tools_dict[tool.name] = tool
 
-        self.llm = LLM(self.api_key, tools=self.tools)
+        # llm can be swapped for a stand-in with the same interface, e.g. replay.ReplayLLM
+        self.llm = llm if llm is not None else LLM(self.api_key, tools=self.tools)
+        # The declarations go with every call, so the history counts them when calibrating its token estimate
+        self.history.overhead_chars = len(json.dumps(self.tools, default=str)) if self.tools else 0
         
     def load_system_prompt(self, fname):
         sys_prompt = ""
@@ -54,34 +76,146 @@ class Nate:
         self.chat_hist.append(msg)
        
     def call(self):
-        content, usage = self.llm.call(self.chat_hist)
+        with tracing.span("llm") as span:
+            content, usage = self.llm.call(self.history.contents(self.objs))
+            span.set(**usage)
+        self.history.record_usage(usage)
         self.chat_hist.append(content) # Model's Tool Call
-        call_again = False
+        function_calls = []
         for part in content.parts:
             if part.text is not None:
                 self.print_message("NATE", part.text)
             elif part.function_call is not None:
-                call_again = True
                 self.print_message("TOOL", part.function_call.name + str(part.function_call.args))
-                tool_result = self.call_tool(part.function_call)
+                function_calls.append(part.function_call)
 
+        if function_calls:
+            tool_results = self.call_tools(function_calls)
+            for function_call, tool_result in zip(function_calls, tool_results):
                 function_response_part = types.Part.from_function_response(
-                    name=part.function_call.name,
+                    name=function_call.name,
                     response={"result": tool_result},
                 )
                 self.chat_hist.append(types.Content(role="user", parts=[function_response_part])) # tool repsponse
-        if call_again:
             self.call()
 
+    async def acall(self):
+        """ Streaming, async version of call(). Text is printed as it arrives, and each tool
+        call starts on a worker thread as soon as it is complete, while the model is still
+        streaming. Many Nate sessions can be driven from one event loop this way. """
+        usage = {}
+        parts = []
+        calls = []  # (function_call, task), in the order the model made them
+        creating = {}  # dataframe_name -> task of the call this turn that creates it
+        stored = set()  # tasks whose object is already in self.objs
+        streaming_text = False
+        turn_span = tracing.current()
+        with tracing.span("llm", stream=True) as span:
+            async for part in self.llm.call_stream(self.history.contents(self.objs), usage):
+                parts.append(part)
+                if part.text is not None:
+                    if not streaming_text:
+                        print("\nNATE:")
+                        streaming_text = True
+                    print(part.text, end="", flush=True)
+                elif part.function_call is not None:
+                    function_call = part.function_call
+                    self.print_message("TOOL", function_call.name + str(function_call.args))
+                    args = function_call.args or {}
+                    depends_on = [creating[name] for name in self.reads_objs(args) if name in creating]
+                    task = asyncio.create_task(self.arun_tool(function_call, depends_on, turn_span, stored))
+                    calls.append((function_call, task))
+                    if args.get("dataframe_name") is not None:
+                        creating[args["dataframe_name"]] = task
+            span.set(**usage)
+        if streaming_text:
+            print("\n")
+
+        self.history.record_usage(usage)
+        self.chat_hist.append(types.Content(role="model", parts=merge_text_parts(parts))) # Model's Tool Call
+        if calls:
+            for function_call, task in calls:
+                tool_result, obj = await task
+                self.store_result(task, obj, stored)
+                function_response_part = types.Part.from_function_response(
+                    name=function_call.name,
+                    response={"result": tool_result},
+                )
+                self.chat_hist.append(types.Content(role="user", parts=[function_response_part])) # tool repsponse
+            await self.acall()
+
+    async def arun_tool(self, function_call, depends_on=(), parent=None, stored=None):
+        # Store what earlier calls this turn created before running a call that reads it
+        for task in depends_on:
+            _, obj = await task
+            self.store_result(task, obj, stored if stored is not None else set())
+        # Tools started mid-stream belong to the turn, not to the llm span they started under
+        return await asyncio.to_thread(tracing.propagate(self.run_tool, parent), function_call)
+
+    def store_result(self, task, obj, stored):
+        """ Stores the object a tool call task returned, once, however many calls waited on it """
+        if task in stored:
+            return
+        stored.add(task)
+        if obj is not None:
+            self.objs[obj.name] = obj
+
     def print_message(self, role, message):
         print("\n" + role + ":\n" + message + "\n")
-        
+
+    def call_tools(self, function_calls):
+        """ Runs the function calls from one model turn and returns their results in order.
+
+        Calls run concurrently in waves. A call that reads a DataFrame another call in the
+        same turn is creating waits for a later wave. Tools only read self.objs while a wave
+        runs; the objects they return are stored afterwards, in call order.
+        """
+        results = [None] * len(function_calls)
+        pending = list(range(len(function_calls)))
+        while pending:
+            wave = []
+            creating = set()
+            for i in pending:
+                args = function_calls[i].args or {}
+                if not (self.reads_objs(args) & creating):
+                    wave.append(i)
+                if args.get("dataframe_name") is not None:
+                    creating.add(args["dataframe_name"])
+            pending = [i for i in pending if i not in wave]
+
+            with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_TOOLS, len(wave))) as pool:
+                futures = [pool.submit(tracing.propagate(self.run_tool), function_calls[i]) for i in wave]
+                for i, future in zip(wave, futures):
+                    tool_result, obj = future.result()
+                    if obj is not None:
+                        self.objs[obj.name] = obj
+                    results[i] = tool_result
+        return results
+
+    def reads_objs(self, args):
+        """ Names of data objects a tool call's arguments refer to """
+        return {value for key, value in args.items() if key in ("df", "dataframe") and isinstance(value, str)}
+
+    def run_tool(self, function_call):
+        with tracing.span("tool", tool=function_call.name, args=function_call.args) as span:
+            with tracing.profiled(span):
+                tool_result, obj = self.tools_dict[function_call.name].call(self.objs, **function_call.args)
+            span.set(result_chars=len(str(tool_result)))
+            if isinstance(tool_result, str) and tool_result.startswith("Error"):
+                span.set(error=tool_result[:200])
+            if obj is not None and hasattr(obj, 'data'):
+                span.set(rows=len(obj.data))
+        return tool_result, obj
+
     def call_tool(self, function_call):
-        tool_result, obj = self.tools_dict[function_call.name].call(self.objs, **function_call.args)
+        tool_result, obj = self.run_tool(function_call)
         if obj is not None:
             self.objs[obj.name] = obj
         return tool_result
 
+    async def aget_user_input(self):
+        await asyncio.to_thread(self.get_user_input)
+
     def get_user_input(self):
         print("\nUSER:")
         user_input = input()
@@ -90,13 +224,27 @@ class Nate:
             print('quitting...')
             quit()
 
+
+def merge_text_parts(parts):
+    """ Joins consecutive streamed text pieces back into single parts """
+    merged = []
+    for part in parts:
+        plain = part.text is not None and not part.thought and not part.thought_signature
+        if plain and merged and merged[-1].text is not None and not merged[-1].thought and not merged[-1].thought_signature:
+            merged[-1] = types.Part(text=merged[-1].text + part.text)
+        else:
+            merged.append(part)
+    return merged
+
     
 def main(args):
 
     api_key = os.getenv("API_KEY")
     fname = "prompt.txt"
-    tools = [GetTaxonID, GetLocationID, GetObservationSummary, GetObservations, ReadDF, PlotHistogram, PlotXY]
+    tools = TOOLS
     objs = None
+    tracing.configure(args.trace, args.profile)
+    plotting.configure(args.plot_dir, args.plot_format)
 
     if args.test:
         import pandas as pd
@@ -105,14 +253,33 @@ def main(args):
         obj_raw = pd.read_csv(df_fname)
         obj = DataFrame("test_df", obj_raw)
         objs={obj.name: obj}
-    nate = Nate(api_key, fname, tools=tools, objs=objs)
+    nate = Nate(api_key, fname, tools=tools, objs=objs, token_budget=args.token_budget, memory_budget=int(args.memory_budget * 2**20))
+
+    snapshot = Snapshot(args.snapshot) if args.snapshot else None
+    if snapshot is not None and snapshot.exists():
+        names = snapshot.restore(nate.objs, nate.history if args.restore_history else None)
+        print(f"Restored {len(names)} data objects from {args.snapshot}: {', '.join(names)}")
 
     print("\nNATE:")
     print("Hello, I'm an assistant for helping you find answers to your ecological questions. What would you like me to do?")
 
+    if args.no_stream:
+        while True:
+            nate.get_user_input()
+            with tracing.span("turn"):
+                nate.call()
+            if snapshot is not None:
+                snapshot.save(nate.objs, nate.history)
+    asyncio.run(converse(nate, snapshot))
+
+
+async def converse(nate, snapshot=None):
     while True:
-        nate.get_user_input()
-        nate.call()
+        await nate.aget_user_input()
+        with tracing.span("turn"):
+            await nate.acall()
+        if snapshot is not None:
+            await asyncio.to_thread(snapshot.save, nate.objs, nate.history)
 
 
 if __name__ == "__main__":
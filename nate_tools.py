@@ -2,17 +2,71 @@
 # Tools that the inaturalist agent can call
 
 #from pyinaturalist import *
-from pyinaturalist import get_taxa, get_observation_species_counts, TaxonCount
 import requests
 import pandas as pd
 import pdb
-import re
 from datetime import datetime
 import math
+import operator
+import numpy as np
+import pyarrow as pa
 import plotly.express as px
 import plotly.graph_objects as go
+from concurrent.futures import ThreadPoolExecutor
+
+import opendata
+import plotting
+import taxonomy
+import tracing
+from checkpoints import Checkpoint
+from data_objects import DataFrame, ObservationDataFrame
+from inat_client import RETRY_STATUSES, fetch_all_pages, fetch_observations, get_json
+from observation_parser import COLUMNS, parse_page, build_frame, compact, resolve_columns, fields_param
+from places import get_place_cache
+from spatial import grid_counts, haversine_km
+
+BATCH_WORKERS = 4
+MAX_BATCH = 50
+
+
+def request_error(e):
+    """ Turns a failed API request into the error string handed back to the model """
+    if isinstance(e, requests.exceptions.HTTPError):
+        return f"Error: API request failed with status {e.response.status_code}"
+    if isinstance(e, requests.exceptions.RequestException):
+        return f"Error: Request failed - {str(e)}"
+    return f"Error: Failed to parse JSON response - {str(e)}"
+
+
+def is_transient(e):
+    """ True if a failed API request may succeed when tried again: a dropped connection,
+    a timeout, rate limiting or a server error """
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and e.response.status_code in RETRY_STATUSES
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def fetch_batch(fetch, taxon_ids, place_ids, params=None, **kwargs):
+    """ Runs fetch(params, **kwargs) for every (taxon_id, place_id) pair concurrently and
+    stacks the results into one frame, keyed by query_taxon_id and query_place_id """
+    pairs = [(taxon_id, place_id) for taxon_id in taxon_ids for place_id in place_ids]
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as pool:
+        fetch_pair = tracing.propagate(lambda pair: fetch(dict(params or {}, taxon_id=pair[0], place_id=pair[1]), **kwargs))
+        frames = pool.map(fetch_pair, pairs)
+        frames = [df.assign(query_taxon_id=taxon_id, query_place_id=place_id)
+                  for (taxon_id, place_id), df in zip(pairs, frames)]
+    df = pd.concat(frames, ignore_index=True)
+    return df[['query_taxon_id', 'query_place_id'] + [col for col in df.columns if not col.startswith('query_')]]
+
+
+def check_batch_ids(taxon_ids, place_ids):
+    """ Returns an error string if the id lists for a batch tool are unusable, else None """
+    if not isinstance(taxon_ids, list) or not isinstance(place_ids, list) or not taxon_ids or not place_ids:
+        return "Error: taxon_ids and place_ids must be non-empty lists"
+    if len(taxon_ids) * len(place_ids) > MAX_BATCH:
+        return f"Error: at most {MAX_BATCH} taxon_id/place_id combinations per call"
+    return None
 
-from data_objects import DataFrame
 
 class Tool():
 
@@ -64,7 +118,19 @@ class GetTaxonID(Tool):
 
     @classmethod
     def call(cls, objs, taxon_str, iconic_taxon_name=None, rank="species"):
-        results = get_taxa(q=taxon_str, rank=rank)['results']
+        index = taxonomy.get_index()
+        local = index.search(taxon_str, rank=rank, iconic_taxon_name=iconic_taxon_name)
+        # A name the index already knows exactly is answered without a request
+        if local and local[0]['matched_term'].lower() == taxon_str.strip().lower():
+            return local, None
+        try:
+            results = get_json('/taxa', {'q': taxon_str, 'rank': rank})['results']
+        except requests.exceptions.RequestException as e:
+            # Offline, the closest names the index knows are better than nothing
+            if local:
+                return local, None
+            return request_error(e), None
+        index.add(results)
         results_abbreviated = cls.abbreviate_organism_search_results(results, iconic_taxon_name=iconic_taxon_name)
         return results_abbreviated, None
 
@@ -119,11 +185,7 @@ class GetLocationID(Tool):
 
     @classmethod
     def call(cls, objs, location_str):
-        url = "https://api.inaturalist.org/v1/places/autocomplete?q="
-        url += location_str
-        url += "&order_by=area"
-        response = requests.get(url)
-        res = response.json()
+        res = get_json('/places/autocomplete', {'q': location_str, 'order_by': 'area'})
         
         results_abbreviated = cls.abbreviate_location_search_result(res['results'])
         return results_abbreviated, None
@@ -132,6 +194,11 @@ class GetLocationID(Tool):
     def abbreviate_location_search_result(cls, res):
         if not res:
             return {}
+        # The results are places too, so ancestors that are also results need no lookup
+        place_cache = get_place_cache()
+        place_cache.add(res)
+        ancestor_ids = {i for res_ in res for i in (res_.get('ancestor_place_ids') or []) if i != res_['id']}
+        places = place_cache.resolve(ancestor_ids)
         results = []
         for res_ in res:
             location = {}
@@ -141,18 +208,20 @@ class GetLocationID(Tool):
             location['place_type'] = res_['place_type']
             location['admin_level'] = res_['admin_level']
             location['location'] = res_['location']
-            location['ancestor_place_ids'] = cls.get_ancestor_names(res_['ancestor_place_ids'])
+            location['ancestor_place_ids'] = cls.get_ancestor_names(
+                [i for i in (res_.get('ancestor_place_ids') or []) if i != res_['id']], places)
             results.append(location)
         return results
-           
+
     @classmethod
-    def get_ancestor_names(cls, ids):
-        return None
-        #if not ids:
-        #    return None
-        #return ids
-        #for id in ids:
-        #    pass 
+    def get_ancestor_names(cls, ids, places=None):
+        """ Returns [id, name] pairs for a list of place ids, outermost first. The name is None
+        for places that couldn't be looked up """
+        if not ids:
+            return None
+        if places is None:
+            places = get_place_cache().resolve(ids)
+        return [[i, places[i]['name'] if i in places else None] for i in ids]
 
 
 class GetObservationSummary(Tool):
@@ -182,41 +251,54 @@ class GetObservationSummary(Tool):
         }
     }
 
+    # Flattened species_counts field -> DataFrame column
+    COLUMNS = {
+        'taxon.id': 'taxon_id',
+        'taxon.rank': 'rank',
+        'taxon.iconic_taxon_id': 'iconic_taxon_id',
+        'taxon.name': 'name',
+        'taxon.ancestry': 'ancestry',
+        'taxon.extinct': 'extinct',
+        'taxon.default_photo.url': 'photo_url',
+        'taxon.default_photo.attribution': 'photo_attribution',
+        'taxon.observations_count': 'observations_count',
+        'taxon.wikipedia_url': 'wikipedia_url',
+        'taxon.iconic_taxon_name': 'iconic_taxon_name',
+        'taxon.conservation_status.status_name': 'conservaton_status',
+        'taxon.preferred_common_name': 'preferred_common_name'
+    }
+
     @classmethod
     def call(cls, objs, taxon_id=None, place_id=None, dataframe_name=False):
         if taxon_id is None or place_id is None:
             return "Need a taxon_id or a place_id", None
-        results = get_observation_species_counts(place_id=place_id, taxon_id=taxon_id)
+        params = {'place_id': place_id, 'taxon_id': taxon_id}
 
         if dataframe_name is None:
+            results = get_json('/observations/species_counts', params)
             results = str(results)[:300]  # DO NOT REMOVE otherwise the output is HUGE and will use up all my tokens!
             results = results[:250] + "\n\nPartial answer because this is still under development."
             print(results)
             return results, None
-       
-        results = results['results']
-        data_dict = {
-            'taxon_id': [res['taxon']['id'] for res in results],
-            'rank': [res['taxon']['rank'] for res in results],
-            'iconic_taxon_id': [res['taxon']['iconic_taxon_id'] for res in results],
-            'name': [res['taxon']['name'] for res in results],
-            'ancestry': [res['taxon']['ancestry'] for res in results],
-            'extinct': [res['taxon']['extinct'] for res in results],
-            'photo_url': [res['taxon']['default_photo']['url'] for res in results],
-            'photo_attribution': [res['taxon']['default_photo']['attribution'] for res in results],
-            'observations_count': [res['taxon']['observations_count'] for res in results],
-            'wikipedia_url': [res['taxon']['wikipedia_url'] for res in results],
-            'iconic_taxon_name': [res['taxon']['iconic_taxon_name'] for res in results],
-            'conservaton_status': [res['taxon']['conservation_status']['status_name'] if 'conservation_status' in res['taxon'] else None for res in results],
-            'preferred_common_name': [res['taxon']['preferred_common_name'] if 'preferred_common_name' in res['taxon'] else None for res in results]
-        }
 
-        df = pd.DataFrame(data_dict)
+        try:
+            df = cls.fetch(params)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            return request_error(e), None
         if df is None:
             return "No DataFrame Produced", None
         DF = DataFrame(dataframe_name, df)
         return DF.get_summary(), DF
 
+    @classmethod
+    def fetch(cls, params):
+        results = fetch_all_pages('/observations/species_counts', params)
+        taxonomy.get_index().add(result.get('taxon') for result in results)
+
+        # Flatten every result in one pass, then pick out the columns we keep
+        flat = pd.json_normalize(results)
+        return flat.reindex(columns=list(cls.COLUMNS)).rename(columns=cls.COLUMNS)
+
 
 class GetObservations(Tool):
 
@@ -250,6 +332,13 @@ class GetObservations(Tool):
                 "n": {
                     "type": "integer",
                     "description": "Max number of observations to return, default is unlimited"
+                },
+                "columns": {
+                    "type": "array",
+                    "description": "Columns to fetch, defaults to all. Ask for fewer to make big pulls faster, e.g. [\"latitude\", \"longitude\", \"observed_on\"] for a map. observation_id and updated_at are always included. Available: " + ", ".join(COLUMNS + ["attribution"]),
+                    "items": {
+                        "type": "string"
+                    }
                 }
                 # Consider replacing d1, d2, etc. with an open "params" input object/string
 
@@ -259,116 +348,457 @@ class GetObservations(Tool):
     }
 
     @classmethod
-    def call(cls, objs, taxon_id=None, place_id=None, dataframe_name=False, d1=None, d2=None, n=None):
+    def call(cls, objs, taxon_id=None, place_id=None, dataframe_name=False, d1=None, d2=None, n=None, columns=None):
 
         # Parameter validation
         if taxon_id is None or place_id is None:
             return "Error: taxon_id and place_id are required", None
+        if columns is not None:
+            unknown = set(columns) - set(COLUMNS + ["attribution"])
+            if unknown:
+                return f"Error: Unknown columns: {unknown}", None
 
-        api_url = 'https://api.inaturalist.org/v1/observations'
         params = {
             'taxon_id': taxon_id,
             'place_id': place_id,
-            'per_page': 100  # Will be adjusted per page as needed
         }
         if d1 is not None:
             params['d1'] = d1
         if d2 is not None:
             params['d2'] = d2
 
-        all_results = []
-        page = 1
-
-        while True:
-            # Adjust per_page for final page when n is specified
-            remaining = n - len(all_results) if n else params['per_page']
-            params['per_page'] = min(100, max(1, remaining)) if remaining > 0 else params['per_page']
+        try:
+            df = cls.fetch(params, n=n, columns=columns)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            if is_transient(e):
+                return request_error(e) + ". Progress has been saved; call GetObservations again with the same arguments to resume.", None
+            return request_error(e), None
 
-            print(f"Fetching page {page}...")
-            params['page'] = page
+        # Make and return the Nate DataFrame 
+        if df is None:
+            return "No DataFrame Produced", None
+        DF = ObservationDataFrame(dataframe_name, df, params, n=n)
+        return DF.get_summary(), DF
+        #return str(df)[:500], None
 
-            try:
-                response = requests.get(api_url, params=params, timeout=30)
-                if response.status_code != 200:
-                    return f"Error: API request failed with status {response.status_code}", None
+    @classmethod
+    def fetch(cls, params, n=None, columns=None):
+        # Ask the API for only the fields the requested columns are built from
+        columns = resolve_columns(columns)
+        params = dict(params, fields=fields_param(columns))
+        checkpoint = Checkpoint.for_query(params, n)
+        chunks = fetch_observations(params, n=n, parse=parse_page, checkpoint=checkpoint)
+        return build_frame(chunks, n=n, columns=columns)
 
-                data = response.json()
-            except requests.exceptions.RequestException as e:
-                return f"Error: Request failed - {str(e)}", None
-            except ValueError as e:
-                return f"Error: Failed to parse JSON response - {str(e)}", None
-
-            observations = data.get("results", [])
-
-            if not observations:
-                break
-
-            all_results.extend(observations)
-
-            # Check if we've reached the limit
-            if n and len(all_results) >= n:
-                all_results = all_results[:n]
-                break
-
-            # Check if this was the last page (fewer results than requested per_page)
-            if len(observations) < params['per_page']:
-                break
-
-            page += 1
-    
-        parsed_data = []
-        for obs in all_results:
-            # Safely extract nested data with a fallback
-            taxon = obs.get('taxon', {})
-            user = obs.get('user', {})
-            photos = obs.get('photos', [])
-            default_photo = photos[0] if photos else {}
-    
-            # Construct attribution string
-            attribution = ""
-            if 'id' in obs and user.get('login'):
-                attribution = f"Photo by {user['login']} via iNaturalist. View the observation: https://www.inaturalist.org/observations/{obs['id']}"
-    
-            parsed_data.append({
-                'observation_id': obs.get('id'),
-                'verifiable': obs.get('verifiable'),
-                'quality_grade': obs.get('quality_grade'),
-                'observed_on': obs.get('observed_on'),
-                'created_at': obs.get('created_at'),
-                'latitude': obs.get('latitude'),
-                'longitude': obs.get('longitude'),
-                'scientific_name': taxon.get('name'),
-                'common_name': taxon.get('preferred_common_name'),
-                'taxon_id': taxon.get('id'),
-                'user_id': user.get('id'),
-                'user_login': user.get('login'),
-                'place_ids': obs.get('place_ids'),
-                'wikipedia_url': taxon.get('wikipedia_url'),
-                'default_photo_url': default_photo.get('url'),
-                'default_photo_attribution': default_photo.get('attribution'),
-                'all_photo_urls': [photo.get('url') for photo in photos],
-                'attribution': attribution
-            })
-    
-        df = pd.DataFrame(parsed_data)
-        
-        # Convert dates to datetime objects for better handling
-        df['observed_on'] = pd.to_datetime(df['observed_on'], errors='coerce')
-        df['created_at'] = pd.to_datetime(df['created_at'], errors='coerce')
+    @classmethod
+    def refresh(cls, DF):
+        """ Fetches observations added or changed since DF was built and merges them in by observation_id """
+        updated_since, max_id = DF.high_water_mark()
+        columns = [col for col in COLUMNS if col in DF.data.columns]
+        params = dict(DF.query, fields=fields_param(columns))
+        if updated_since is not None:
+            params['updated_since'] = updated_since.isoformat()
+        elif max_id is not None:
+            params['id_above'] = max_id
+
+        # The cache would hand back the previous refresh's answer, so always go to the network
+        new_df = build_frame(fetch_observations(params, use_cache=False, parse=parse_page), columns=columns)
+        df = pd.concat([DF.data, new_df], ignore_index=True)
+        df = df.drop_duplicates('observation_id', keep='last')
+        df = df.sort_values('observation_id', ascending=False, ignore_index=True)
+        if DF.n:
+            df = df.head(DF.n)
+        df = compact(df)
+        return ObservationDataFrame(DF.name, df, DF.query, n=DF.n), len(new_df)
+
+
+class RefreshObservations(Tool):
+
+    name = "RefreshObservations"
+    declaration = {
+        "name": name,
+        "description": "Update a DataFrame made by GetObservations with any observations that were added or changed since it was fetched. Much cheaper than calling GetObservations again.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "df": {
+                    "type": "string",
+                    "description": "Name of the DataFrame to refresh"
+                }
+            },
+            "required": ["df"]
+        }
+    }
 
-       
-        # Make and return the Nate DataFrame 
+    @classmethod
+    def call(cls, objs, df=None):
         if df is None:
-            return "No DataFrame Produced", None
+            return "Error: df parameter is required", None
+        if df not in objs:
+            return f"Error: DataFrame '{df}' not found", None
+        if not isinstance(objs[df], ObservationDataFrame):
+            return f"Error: DataFrame '{df}' was not made by GetObservations", None
+        if objs[df].query is None:
+            return f"Error: DataFrame '{df}' was built from several queries and cannot be refreshed", None
+
+        try:
+            DF, n_new = GetObservations.refresh(objs[df])
+        except (requests.exceptions.RequestException, ValueError) as e:
+            return request_error(e), None
+
+        return f"Fetched {n_new} new or updated observations. " + DF.get_summary(), DF
+
+
+class GetObservationSummaryBatch(Tool):
+
+    name = "GetObservationSummaryBatch"
+    declaration = {
+        "name": name,
+        "description": "Same as GetObservationSummary, but for every combination of several taxon_ids and place_ids at once. Returns one DataFrame with query_taxon_id and query_place_id columns saying which combination each row came from. Use this instead of calling GetObservationSummary repeatedly.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "taxon_ids": {
+                    "type": "array",
+                    "description": "taxon_ids by which to filter observations",
+                    "items": {
+                        "type": "integer"
+                    }
+                },
+                "place_ids": {
+                    "type": "array",
+                    "description": "place_ids for the geographic regions that observations are pulled from",
+                    "items": {
+                        "type": "integer"
+                    }
+                },
+                "dataframe_name": {
+                    "type": "string",
+                    "description": "Name of DataFrame that stores result"
+                }
+            },
+            "required": ["taxon_ids", "place_ids", "dataframe_name"]
+        }
+    }
+
+    @classmethod
+    def call(cls, objs, taxon_ids=None, place_ids=None, dataframe_name=None):
+        error = check_batch_ids(taxon_ids, place_ids)
+        if error is not None:
+            return error, None
+        if dataframe_name is None:
+            return "Error: dataframe_name is required", None
+
+        try:
+            df = fetch_batch(GetObservationSummary.fetch, taxon_ids, place_ids)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            return request_error(e), None
         DF = DataFrame(dataframe_name, df)
         return DF.get_summary(), DF
-        #return str(df)[:500], None
+
+
+class GetObservationsBatch(Tool):
+
+    name = "GetObservationsBatch"
+    declaration = {
+        "name": name,
+        "description": "Same as GetObservations, but for every combination of several taxon_ids and place_ids at once. Returns one DataFrame with query_taxon_id and query_place_id columns saying which combination each row came from. Use this instead of calling GetObservations repeatedly.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "taxon_ids": {
+                    "type": "array",
+                    "description": "taxon_ids by which to filter observations",
+                    "items": {
+                        "type": "integer"
+                    }
+                },
+                "place_ids": {
+                    "type": "array",
+                    "description": "place_ids for the geographic regions that observations are pulled from",
+                    "items": {
+                        "type": "integer"
+                    }
+                },
+                "dataframe_name": {
+                    "type": "string",
+                    "description": "Name of DataFrame that stores result"
+                },
+                "d1": {
+                    "type": "string",
+                    "description": "Earliest datetime for observations, formatted YYYY-MM-DD"
+                },
+                "d2": {
+                    "type": "string",
+                    "description": "Latest datetime cutoff for observations, formatted YYYY-MM-DD"
+                },
+                "n": {
+                    "type": "integer",
+                    "description": "Max number of observations to return for each taxon/place combination, default is unlimited"
+                },
+                "columns": {
+                    "type": "array",
+                    "description": "Columns to fetch, defaults to all. observation_id and updated_at are always included. Available: " + ", ".join(COLUMNS + ["attribution"]),
+                    "items": {
+                        "type": "string"
+                    }
+                }
+            },
+            "required": ["taxon_ids", "place_ids", "dataframe_name"]
+        }
+    }
+
+    @classmethod
+    def call(cls, objs, taxon_ids=None, place_ids=None, dataframe_name=None, d1=None, d2=None, n=None, columns=None):
+        error = check_batch_ids(taxon_ids, place_ids)
+        if error is not None:
+            return error, None
+        if columns is not None:
+            unknown = set(columns) - set(COLUMNS + ["attribution"])
+            if unknown:
+                return f"Error: Unknown columns: {unknown}", None
+        if dataframe_name is None:
+            return "Error: dataframe_name is required", None
+
+        params = {}
+        if d1 is not None:
+            params['d1'] = d1
+        if d2 is not None:
+            params['d2'] = d2
+
+        try:
+            df = compact(fetch_batch(GetObservations.fetch, taxon_ids, place_ids, params, n=n, columns=columns))
+        except (requests.exceptions.RequestException, ValueError) as e:
+            return request_error(e), None
+        DF = ObservationDataFrame(dataframe_name, df, None)
+        return DF.get_summary(), DF
+
+
+class QueryLocalObservations(Tool):
+
+    name = "QueryLocalObservations"
+    declaration = {
+        "name": "QueryLocalObservations",
+        "description": "Get a dataframe of individual observations from the local copy of the iNaturalist open data export instead of the API. Answers the same taxon/place/date questions as GetObservations, but in seconds for state-wide, multi-year or very large pulls, and offline. The export has no common names, observation ids or update times, and may be some weeks old.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "taxon_id": {
+                    "type": "integer",
+                    "description": 'taxon_id by which to filter observations; taxa below it are included. At least one of taxon_id and place_id is required'
+                },
+                "place_id": {
+                    "type": "integer",
+                    "description": 'place_id for the georaphic region that observations are pulled from. At least one of taxon_id and place_id is required'
+                },
+                "dataframe_name": {
+                    "type": "string",
+                    "description": "Name of DataFrame that stores result"
+                },
+                "d1": {
+                    "type": "string",
+                    "description": "Earliest date for observations, formatted YYYY-MM-DD"
+                },
+                "d2": {
+                    "type": "string",
+                    "description": "Latest date for observations, formatted YYYY-MM-DD"
+                },
+                "quality_grade": {
+                    "type": "string",
+                    "enum": ["research", "needs_id", "casual"],
+                    "description": "Keep only observations of this quality grade"
+                },
+                "photos": {
+                    "type": "boolean",
+                    "description": "Add a default_photo_url column. Default false."
+                },
+                "n": {
+                    "type": "integer",
+                    "description": "Max number of observations to keep, newest first. Default all."
+                }
+            },
+            "required": ["dataframe_name"]
+        }
+    }
+
+    @classmethod
+    def call(cls, objs, dataframe_name=None, taxon_id=None, place_id=None, d1=None, d2=None, quality_grade=None, photos=False, n=None):
+        if dataframe_name is None:
+            return "Error: dataframe_name is required", None
+        if taxon_id is None and place_id is None:
+            return "Error: taxon_id or place_id is required", None
+        if not opendata.has_store():
+            return "Error: No local observation store. Load the open data export with: python opendata.py ingest <export dir>", None
+        try:
+            df = opendata.query(taxon_id=taxon_id, place_id=place_id, d1=d1, d2=d2, quality_grade=quality_grade, photos=photos, limit=n)
+        except requests.exceptions.RequestException as e:
+            return request_error(e) + " while looking up the place boundary", None
+        except ValueError as e:
+            return f"Error: {e}", None
+        DF = DataFrame(dataframe_name, df)
+        return DF.get_summary(), DF
+
+
+FILTER_OPS = {
+    "=": operator.eq, "==": operator.eq, "!=": operator.ne,
+    ">": operator.gt, "<": operator.lt, ">=": operator.ge, "<=": operator.le,
+}
+TAXON_OPS = {"descendant_of"}  # ops on taxon id columns answered from the taxonomy index
+LIST_OPS = {"contains"}  # ops on list columns answered from the frame's ListIndex
+MAX_NEAREST = 1000  # most rows a nearest-point query keeps
+PARTIAL_SORT_FACTOR = 8  # below len(rows) / n, sorting only the candidates for the top n beats a full sort
+
+
+def column_values(DF, data, column):
+    """ Returns a stored column of data, or computes a derived one over all rows """
+    if column in data.columns:
+        return data[column]
+    if column in DF.derived_columns and column in DF.column_names():
+        return DF.derived_columns[column][0](data)
+    raise ValueError(f"Column '{column}' not found")
+
+
+def cast_filter_value(dtype, value):
+    """ Casts a filter value given as a string to something comparable with a column of dtype """
+    try:
+        if isinstance(dtype, pd.CategoricalDtype):
+            return cast_filter_value(dtype.categories.dtype, value)
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            timestamp = pd.to_datetime(value)
+            tz = getattr(dtype, 'tz', None)
+            # Compare zone-aware columns against the same instant, reading naive values as that zone
+            if tz is not None:
+                timestamp = timestamp.tz_localize(tz) if timestamp.tzinfo is None else timestamp.tz_convert(tz)
+            elif timestamp.tzinfo is not None:
+                timestamp = timestamp.tz_convert(None)
+            return timestamp
+        # Booleans count as numeric to pandas, so they are checked first
+        if pd.api.types.is_bool_dtype(dtype):
+            if str(value).lower() in ['true', '1', 't', 'y', 'yes']:
+                return True
+            if str(value).lower() in ['false', '0', 'f', 'n', 'no']:
+                return False
+            raise ValueError(f"Cannot convert '{value}' to boolean.")
+        if pd.api.types.is_numeric_dtype(dtype):
+            return pd.to_numeric(value)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Could not cast value '{value}' to type '{dtype}': {e}")
+    return value
+
+
+def filter_mask(DF, data, query_tuples):
+    """ Returns a boolean numpy mask of the rows of data matching every (column, op, value)
+    tuple, or None if there are no filters. Missing values never match. """
+    if query_tuples is None:
+        return None
+    if type(query_tuples) != list:
+        raise ValueError("query_tuples must be a list")
+    mask = None
+    for qt in query_tuples:
+        if len(qt) != 3:
+            raise ValueError(f"Invalid query tuple: {qt}. Must be (column, op, value).")
+        column, op, value = qt
+        if op not in FILTER_OPS and op not in TAXON_OPS and op not in LIST_OPS:
+            raise ValueError("Operation not allowed")
+        if column not in data.columns and column not in DF.column_names():
+            raise ValueError("Column not found")
+        series = column_values(DF, data, column)
+        if op == "descendant_of":
+            matches = descendant_mask(series, value)
+        elif op == "contains":
+            if column not in data.columns:
+                raise ValueError("contains needs a stored list column")
+            index = DF.list_index(column)
+            matches = index.mask(cast_filter_value(index.keys.dtype, value))
+        elif isinstance(series.dtype, pd.CategoricalDtype):
+            # Compared on the distinct categories, since unordered categoricals only allow == and !=
+            categories = series.cat.categories
+            try:
+                category_matches = np.asarray(FILTER_OPS[op](categories, cast_filter_value(series.dtype, value)), dtype=bool)
+            except TypeError as e:
+                raise ValueError(f"Cannot compare column '{column}' with '{value}': {e}")
+            # Code -1 (missing) picks the trailing False
+            matches = np.append(category_matches, False)[series.cat.codes.to_numpy()]
+        else:
+            try:
+                matches = FILTER_OPS[op](series, cast_filter_value(series.dtype, value))
+            except TypeError as e:
+                raise ValueError(f"Cannot compare column '{column}' with '{value}': {e}")
+            matches = matches.to_numpy(dtype=bool, na_value=False)
+        mask = matches if mask is None else mask & matches
+    return mask
+
+
+def descendant_mask(series, value):
+    """ Returns a boolean numpy mask of the taxon ids in series that are the taxon value or below it """
+    if not pd.api.types.is_numeric_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype):
+        raise ValueError("descendant_of needs a column of taxon ids")
+    ancestor_id = int(cast_filter_value(series.dtype, value))
+    taxon_ids = series.to_numpy(dtype=float, na_value=np.nan)
+    index = taxonomy.get_index()
+    # Only the distinct ids are looked up, and only those the index has never seen
+    distinct = np.unique(taxon_ids[~np.isnan(taxon_ids)]).astype(np.int64)
+    index.fetch(np.append(distinct, ancestor_id))
+    return index.descendant_mask(taxon_ids, ancestor_id)
+
+
+def parse_sort_by(DF, sort_by):
+    """ Returns ([column, ...], [ascending, ...]) from a list of columns or (column, 'asc'/'desc') pairs """
+    if sort_by is None:
+        return [], []
+    if not isinstance(sort_by, list):
+        raise ValueError("sort_by must be a list of columns or (column, 'desc') tuples.")
+
+    sort_cols = []
+    sort_ascending = []
+    for item in sort_by:
+        if isinstance(item, str):
+            col_name, ascending = item, True
+        elif isinstance(item, list) and len(item) == 2 and item[1].lower() in ('asc', 'desc'):
+            col_name, ascending = item[0], item[1].lower() == 'asc'
+        else:
+            raise ValueError(f"Invalid sort item: {item}. Must be 'column_name' or ['column_name', 'desc'/'asc'].")
+
+        if col_name not in DF.column_names():
+            raise ValueError(f"Sort column '{col_name}' not found in DataFrame.")
+        sort_cols.append(col_name)
+        sort_ascending.append(ascending)
+    return sort_cols, sort_ascending
+
+
+def sort_key(series):
+    """ Returns float values that order like series (NaN where missing), or None if it has no numeric order """
+    if pd.api.types.is_bool_dtype(series.dtype) or isinstance(series.dtype, pd.CategoricalDtype):
+        return None
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        values = series.array.asi8.astype(float)
+        values[series.isna().to_numpy()] = np.nan
+        return values
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return series.to_numpy(dtype=float, na_value=np.nan)
+    return None
+
+
+def top_rows(DF, data, rows, sort_cols, sort_ascending, n):
+    """ Returns the positions in rows ordered by sort_cols, at least the first n of them.
+
+    When n is small and the first sort column is numeric or a date, only rows that
+    could be in the top n (first key up to the n-th best value, plus ties) are sorted.
+    """
+    if len(rows) > n * PARTIAL_SORT_FACTOR:
+        key = sort_key(column_values(DF, data, sort_cols[0]).iloc[rows])
+        if key is not None and np.count_nonzero(~np.isnan(key)) >= n:
+            key = key if sort_ascending[0] else -key
+            nth = np.partition(np.where(np.isnan(key), np.inf, key), n - 1)[n - 1]
+            rows = rows[key <= nth]
+    keys = pd.DataFrame({i: column_values(DF, data, col).iloc[rows].reset_index(drop=True) for i, col in enumerate(sort_cols)})
+    order = keys.sort_values(by=list(range(len(sort_cols))), ascending=sort_ascending, kind='stable').index
+    return rows[order.to_numpy()]
 
 
 # TODO:
 # - update the output format to include a text summary, plus a Nate dataframe with the correct name
 # - Consider updating to allow other parameters as inputs
-# - reduce the space used for attributions, and generate on the fly as necessary
 # - Test thouroughly
 # - Add a separate tool for making histograms
 
@@ -399,7 +829,7 @@ class ReadDF(Tool):
             },
             "query_tuples": {
                 "type": "array",
-                "description": "List of len=3 tuples for querying the dataframe, where each tuple has the format (column, op, val). The following operations are allowed: {\"=\", \">\", \"<\", \">=\", \"<=\", \"!=\"}. The value 'val' will be a string and is casted to the correct type by the function.",
+                "description": "List of len=3 tuples for querying the dataframe, where each tuple has the format (column, op, val). The following operations are allowed: {\"=\", \">\", \"<\", \">=\", \"<=\", \"!=\", \"descendant_of\", \"contains\"}. descendant_of keeps rows whose taxon id column (e.g. taxon_id) is the taxon with ID val or any taxon below it, e.g. (\"taxon_id\", \"descendant_of\", \"26036\") for all reptiles. contains keeps rows whose list column holds val, e.g. (\"place_ids\", \"contains\", \"1234\") for observations inside place 1234, which answers sub-region questions without fetching again. The value 'val' will be a string and is casted to the correct type by the function.",
                 "items": {
                     "type": "array",
                     "minItems": 3,
@@ -441,95 +871,376 @@ class ReadDF(Tool):
         if n > 20:
             raise ValueError("n must be less than or equal to 20")
 
-        ALLOWED_OPS = {"=", "==", ">", "<", ">=", "<=", "!="}
-        SAFE_COL_RE = re.compile(r'^[A-Za-z0-9_ ]+$')
-
-        def safe_filter(df_obj, column, op, value):
-            if op not in ALLOWED_OPS:
-                raise ValueError("Operation not allowed")
-            elif op == "=":
-                op = "=="
-            if column not in df_obj.columns:
-                raise ValueError("Column not found")
-            if not SAFE_COL_RE.match(column):
-                raise ValueError(f"Unsafe column name: {column}")
-
-            # Determine the target data type from the DataFrame's dtypes
-            target_dtype = df_obj.dtypes[column]
-            casted_value = None
-        
-            try:
-                # Check if the column is a datetime type
-                if pd.api.types.is_datetime64_any_dtype(target_dtype):
-                    casted_value = pd.to_datetime(value)
-                # Check if the column is a numeric type (int, float)
-                elif pd.api.types.is_numeric_dtype(target_dtype):
-                    casted_value = pd.to_numeric(value)
-                # Check for boolean types
-                elif pd.api.types.is_bool_dtype(target_dtype):
-                    if value.lower() in ['true', '1', 't', 'y', 'yes']:
-                        casted_value = True
-                    elif value.lower() in ['false', '0', 'f', 'n', 'no']:
-                        casted_value = False
-                    else:
-                        raise ValueError(f"Cannot convert '{value}' to boolean.")
-                # If none of the above, assume it's a string and use the original value
-                else:
-                    casted_value = value
-
-            except (ValueError, TypeError) as e:
-                raise ValueError(f"Could not cast value '{value}' to type '{target_dtype}': {e}")
-
-            return f"`{column}` {op} @casted_value", casted_value
-
-
-        df_filt = objs[df].data.copy()
-        cols_filt = df_filt.columns if cols is None else cols
-
-        missing = set(cols_filt) - set(df_filt.columns)
+        DF = objs[df]
+        data = DF.data  # read in place; nothing below modifies it
+        cols_filt = DF.column_names() if cols is None else cols
+
+        missing = set(cols_filt) - set(DF.column_names())
         if missing:
             raise ValueError(f"Columns not found: {missing}")
 
-        if query_tuples is not None:
-            if type(query_tuples) != list:
-                raise ValueError("query_tuples must be a list")
-            for qt in query_tuples:
-                expr, casted_value = safe_filter(df_filt, qt[0], qt[1], qt[2])
-                df_filt = df_filt.query(expr, local_dict={"casted_value": casted_value})
+        mask = filter_mask(DF, data, query_tuples)
+        rows = np.arange(len(data)) if mask is None else np.flatnonzero(mask)
+        sort_cols, sort_ascending = parse_sort_by(DF, sort_by)
+        if sort_cols:
+            rows = top_rows(DF, data, rows, sort_cols, sort_ascending, n)
+        rows = rows[:n]
+
+        # Only the selected rows of the requested columns are ever materialized
+        needed = [col for col in cols_filt if col in data.columns]
+        for col in cols_filt:
+            if col not in data.columns:
+                needed += [c for c in DF.derived_columns[col][1] if c not in needed]
+        out = data.iloc[rows, data.columns.get_indexer(needed)]
+        return str(DF.with_columns(out, cols_filt)[cols_filt]), None
+
+
+class AggregateDF(Tool):
+
+    name = "AggregateDF"
+    declaration = {
+        "name": "AggregateDF",
+        "description": "Group the rows of a DataFrame and aggregate them in one step, e.g. observations per species per month, and save the result as a new DataFrame. Use this instead of reading rows with ReadDF to count, sum or average.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "df": {
+                    "type": "string",
+                    "description": 'DataFrame object name'
+                },
+                "dataframe_name": {
+                    "type": "string",
+                    "description": "Name of DataFrame that stores result"
+                },
+                "group_by": {
+                    "type": "array",
+                    "description": 'Columns to group by. A date column can be bucketed by adding ":day", ":week", ":month", ":year" or ":month_of_year", as in "observed_on:month". Leave empty to aggregate all rows together.',
+                    "items": {
+                        "type": "string"
+                    }
+                },
+                "aggregations": {
+                    "type": "array",
+                    "description": 'List of (column, function) pairs, where function is one of count, sum, mean, min, max, nunique, as in [["user_id", "nunique"]]. Defaults to counting rows per group.',
+                    "items": {
+                        "type": "array",
+                        "minItems": 2,
+                        "maxItems": 2,
+                        "items": {
+                            "type": "string"
+                        }
+                    }
+                },
+                "query_tuples": {
+                    "type": "array",
+                    "description": "Filters applied before grouping, in the same (column, op, val) format as ReadDF.",
+                    "items": {
+                        "type": "array",
+                        "minItems": 3,
+                        "maxItems": 3,
+                        "items": {
+                            "type": "string"
+                        }
+                    }
+                },
+                "sort_by": {
+                    "type": "array",
+                    "description": 'List of (column name, asc/desc) tuples to sort the result by, using the result\'s column names (e.g. "count"). Defaults to the group_by order.',
+                    "items": {
+                        "type": "array",
+                        "items": {
+                            "type": "string"
+                        }
+                    }
+                },
+                "n": {
+                    "type": "integer",
+                    "description": "Number of result rows to show. Default 10, max 50. The full result is always saved."
+                }
+            },
+            "required": ["df", "dataframe_name"]
+        }
+    }
+
+    AGGREGATIONS = {"count", "sum", "mean", "min", "max", "nunique"}
+    # Period codes for date buckets; month_of_year groups every year's month together
+    DATE_BUCKETS = {"day": "D", "week": "W", "month": "M", "year": "Y", "month_of_year": None}
 
-        # --- Sorting Logic ---
+    @classmethod
+    def call(cls, objs, df=None, dataframe_name=None, group_by=None, aggregations=None, query_tuples=None, sort_by=None, n=10):
+        if df is None or df not in objs:
+            return f"Error: DataFrame '{df}' not found", None
+        if dataframe_name is None:
+            return "Error: dataframe_name is required", None
+        if n < 1 or n > 50:
+            return "Error: n must be between 1 and 50", None
+
+        DF = objs[df]
+        data = DF.data
+        try:
+            mask = filter_mask(DF, data, query_tuples)
+            keys = {spec: cls.group_key(DF, data, spec) for spec in group_by or []}
+            columns = {}
+            named_aggs = {}
+            for item in aggregations or [["*", "count"]]:
+                if not isinstance(item, list) or len(item) != 2 or item[1] not in cls.AGGREGATIONS:
+                    raise ValueError(f"Invalid aggregation: {item}. Must be [column, function] with function one of {sorted(cls.AGGREGATIONS)}.")
+                column, func = item
+                if column == "*" and func == "count":
+                    continue
+                if column not in columns:
+                    columns[column] = column_values(DF, data, column)
+                named_aggs[f"{func}_{column}"] = (column, func)
+        except ValueError as e:
+            return f"Error: {e}", None
+
+        # Only the key and value columns are gathered, then filtered once. A plain count needs no columns at all
+        frame = pd.DataFrame({**keys, **columns}, copy=False)
+        if mask is not None and len(frame.columns):
+            frame = frame[mask]
+        n_rows = len(data) if mask is None else int(mask.sum())
+
+        try:
+            if keys:
+                grouped = frame.groupby(list(keys), observed=True, dropna=False, sort=True)
+                result = grouped.agg(**named_aggs) if named_aggs else pd.DataFrame(index=grouped.size().index)
+                if aggregations is None or any(item[0] == "*" for item in aggregations):
+                    result.insert(0, "count", grouped.size())
+                result = result.reset_index()
+            else:
+                row = {name: frame[column].agg(func) for name, (column, func) in named_aggs.items()}
+                if aggregations is None or any(item[0] == "*" for item in aggregations):
+                    row = {"count": n_rows, **row}
+                result = pd.DataFrame([row])
+        except (TypeError, ValueError) as e:
+            return f"Error: Could not aggregate: {e}", None
+
+        result = result.rename(columns={spec: spec.replace(":", "_") for spec in keys})
         if sort_by is not None:
-            if not isinstance(sort_by, list):
-                raise ValueError("sort_by must be a list of columns or (column, 'desc') tuples.")
+            try:
+                result_DF = DataFrame(dataframe_name, result)
+                sort_cols, sort_ascending = parse_sort_by(result_DF, sort_by)
+            except ValueError as e:
+                return f"Error: {e}", None
+            result = result.sort_values(by=sort_cols, ascending=sort_ascending, kind='stable', ignore_index=True)
 
-            sort_cols = []
-            sort_ascending = []
+        DF_out = DataFrame(dataframe_name, result)
+        return DF_out.get_summary() + "\n" + str(result.head(n)), DF_out
 
-            for item in sort_by:
-                col_name = None
-                ascending = True
+    @classmethod
+    def group_key(cls, DF, data, spec):
+        """ Returns the values to group on for a group_by entry such as "quality_grade" or "observed_on:month" """
+        column, _, bucket = spec.partition(":")
+        values = column_values(DF, data, column)
+        if isinstance(values.dtype, pd.ArrowDtype) and pa.types.is_list(values.dtype.pyarrow_dtype):
+            raise ValueError(f"Can't group by list column '{column}'")
+        if not bucket:
+            return values
+        if bucket not in cls.DATE_BUCKETS:
+            raise ValueError(f"Invalid date bucket '{bucket}'. Must be one of {list(cls.DATE_BUCKETS)}.")
+        if not pd.api.types.is_datetime64_any_dtype(values.dtype):
+            raise ValueError(f"Column '{column}' is not a date, so it can't be bucketed by {bucket}")
+        if bucket == "month_of_year":
+            return values.dt.month.astype('Int64')
+        if values.dt.tz is not None:
+            values = values.dt.tz_localize(None)
+        return values.dt.to_period(cls.DATE_BUCKETS[bucket])
+
+
+def spatial_rows(DF, bbox=None, center=None, radius_km=None, nearest=None, mask=None):
+    """ Returns (row positions, distances in km or None) of the rows in a bbox [min_lat, min_lon,
+    max_lat, max_lon], within radius_km of center [lat, lon], or the nearest to center.
+    With no region, every row with coordinates. Only rows where mask is True are considered """
+    if sum(arg is not None for arg in (bbox, radius_km, nearest)) > 1:
+        raise ValueError("Give only one of bbox, radius_km or nearest")
+    if (radius_km is not None or nearest is not None) and center is None:
+        raise ValueError("radius_km and nearest need a center [lat, lon]")
+    if center is not None:
+        if not isinstance(center, list) or len(center) != 2:
+            raise ValueError("center must be [lat, lon]")
+        lat, lon = (float(v) for v in center)
+        if not -90 <= lat <= 90 or not -180 <= lon <= 180:
+            raise ValueError("center must be a valid [lat, lon]")
+    index = DF.spatial_index()
+    if bbox is not None:
+        if not isinstance(bbox, list) or len(bbox) != 4:
+            raise ValueError("bbox must be [min_lat, min_lon, max_lat, max_lon]")
+        min_lat, min_lon, max_lat, max_lon = (float(v) for v in bbox)
+        if min_lat > max_lat:
+            raise ValueError("bbox min_lat must not be above max_lat")
+        return index.in_box(min_lat, min_lon, max_lat, max_lon, mask), None
+    if radius_km is not None:
+        if radius_km <= 0:
+            raise ValueError("radius_km must be positive")
+        return index.within(lat, lon, radius_km, mask)
+    if nearest is not None:
+        if nearest < 1 or nearest > MAX_NEAREST:
+            raise ValueError(f"nearest must be between 1 and {MAX_NEAREST}")
+        return index.nearest(lat, lon, nearest, mask)
+    rows = index.rows if mask is None else index.rows[mask[index.rows]]
+    return np.sort(rows), None
+
+
+REGION_PROPERTIES = {
+    "bbox": {
+        "type": "array",
+        "description": "Box to search, as [min_lat, min_lon, max_lat, max_lon] in degrees",
+        "items": {"type": "number"}
+    },
+    "center": {
+        "type": "array",
+        "description": "Point to search around, as [lat, lon] in degrees. Needed for radius_km and nearest; location from GetLocationID can be used here",
+        "items": {"type": "number"}
+    },
+    "radius_km": {
+        "type": "number",
+        "description": "Keep only rows within this many km of center"
+    },
+}
+
+
+class SpatialQueryDF(Tool):
+
+    name = "SpatialQueryDF"
+    declaration = {
+        "name": "SpatialQueryDF",
+        "description": "Find the rows of a DataFrame with latitude and longitude columns that fall inside a box, within a radius of a point, or are nearest a point, and save them as a new DataFrame. Radius and nearest results are sorted nearest first with a distance_km column. Give exactly one of bbox, radius_km or nearest.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "df": {
+                    "type": "string",
+                    "description": 'DataFrame object name'
+                },
+                "dataframe_name": {
+                    "type": "string",
+                    "description": "Name of DataFrame that stores result"
+                },
+                **REGION_PROPERTIES,
+                "nearest": {
+                    "type": "integer",
+                    "description": f"Keep this many rows nearest center, at most {MAX_NEAREST}"
+                },
+                "query_tuples": {
+                    "type": "array",
+                    "description": "Filters applied first, in the same (column, op, val) format as ReadDF.",
+                    "items": {
+                        "type": "array",
+                        "minItems": 3,
+                        "maxItems": 3,
+                        "items": {
+                            "type": "string"
+                        }
+                    }
+                },
+                "n": {
+                    "type": "integer",
+                    "description": "Number of result rows to show. Default 5, max 20. The full result is always saved."
+                }
+            },
+            "required": ["df", "dataframe_name"]
+        }
+    }
 
-                if isinstance(item, str):
-                    col_name = item
-                elif isinstance(item, list) and len(item) == 2 and item[1].lower() in ('asc', 'desc'):
-                    col_name = item[0]
-                    if item[1].lower() == 'desc':
-                        ascending = False
-                else:
-                    raise ValueError(f"Invalid sort item: {item}. Must be 'column_name' or ['column_name', 'desc'/'asc'].")
+    @classmethod
+    def call(cls, objs, df=None, dataframe_name=None, bbox=None, center=None, radius_km=None, nearest=None, query_tuples=None, n=5):
+        if df is None or df not in objs:
+            return f"Error: DataFrame '{df}' not found", None
+        if dataframe_name is None:
+            return "Error: dataframe_name is required", None
+        if n < 1 or n > 20:
+            return "Error: n must be between 1 and 20", None
+        if bbox is None and radius_km is None and nearest is None:
+            return "Error: give one of bbox, radius_km or nearest", None
+
+        DF = objs[df]
+        data = DF.data
+        try:
+            mask = filter_mask(DF, data, query_tuples)
+            rows, distances = spatial_rows(DF, bbox, center, radius_km, nearest, mask)
+        except ValueError as e:
+            return f"Error: {e}", None
 
-                if col_name not in df_filt.columns:
-                    raise ValueError(f"Sort column '{col_name}' not found in DataFrame.")
+        result = data.iloc[rows].reset_index(drop=True)
+        if distances is not None:
+            result.insert(0, 'distance_km', distances.round(3))
+        if isinstance(DF, ObservationDataFrame):
+            DF_out = ObservationDataFrame(dataframe_name, result, None)
+        else:
+            DF_out = DataFrame(dataframe_name, result)
+        return DF_out.get_summary() + "\n" + str(result.head(n)), DF_out
 
-                sort_cols.append(col_name)
-                sort_ascending.append(ascending)
 
-            # Apply sorting
-            df_filt = df_filt.sort_values(by=sort_cols, ascending=sort_ascending)
+class SpatialCountsDF(Tool):
 
-        # --- End Sorting Logic ---
+    name = "SpatialCountsDF"
+    declaration = {
+        "name": "SpatialCountsDF",
+        "description": "Count the rows of a DataFrame with latitude and longitude columns in square grid cells, like a heatmap, and save the counts as a new DataFrame with cell_lat, cell_lon (cell centres) and count, busiest cells first. Use it to find where something is most commonly seen, optionally only inside a box or within a radius of a point.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "df": {
+                    "type": "string",
+                    "description": 'DataFrame object name'
+                },
+                "dataframe_name": {
+                    "type": "string",
+                    "description": "Name of DataFrame that stores result"
+                },
+                "cell_km": {
+                    "type": "number",
+                    "description": "Width of a grid cell in km. Default 10."
+                },
+                **REGION_PROPERTIES,
+                "query_tuples": {
+                    "type": "array",
+                    "description": "Filters applied before counting, in the same (column, op, val) format as ReadDF.",
+                    "items": {
+                        "type": "array",
+                        "minItems": 3,
+                        "maxItems": 3,
+                        "items": {
+                            "type": "string"
+                        }
+                    }
+                },
+                "n": {
+                    "type": "integer",
+                    "description": "Number of cells to show. Default 10, max 50. Every cell is always saved."
+                }
+            },
+            "required": ["df", "dataframe_name"]
+        }
+    }
 
-        return str(df_filt[cols_filt].head(n)), None
+    @classmethod
+    def call(cls, objs, df=None, dataframe_name=None, cell_km=10, bbox=None, center=None, radius_km=None, query_tuples=None, n=10):
+        if df is None or df not in objs:
+            return f"Error: DataFrame '{df}' not found", None
+        if dataframe_name is None:
+            return "Error: dataframe_name is required", None
+        if n < 1 or n > 50:
+            return "Error: n must be between 1 and 50", None
+        if cell_km <= 0:
+            return "Error: cell_km must be positive", None
+
+        DF = objs[df]
+        data = DF.data
+        try:
+            mask = filter_mask(DF, data, query_tuples)
+            rows, _ = spatial_rows(DF, bbox, center, radius_km, None, mask)
+        except ValueError as e:
+            return f"Error: {e}", None
+
+        latitude = data['latitude'].to_numpy(dtype=float, na_value=np.nan)[rows]
+        longitude = data['longitude'].to_numpy(dtype=float, na_value=np.nan)[rows]
+        result = grid_counts(latitude, longitude, cell_km)
+        if center is not None:
+            result['distance_km'] = haversine_km(center[0], center[1], result['cell_lat'], result['cell_lon']).round(3)
+
+        DF_out = DataFrame(dataframe_name, result)
+        return DF_out.get_summary() + "\n" + str(result.head(n)), DF_out
 
 
 class PlotHistogram(Tool):
@@ -537,7 +1248,7 @@ class PlotHistogram(Tool):
     name = "PlotHistogram"
     declaration = {
         "name": name,
-        "description": "Plot a histogram of a numeric column from a DataFrame using plotly and display it in the browser.",
+        "description": "Plot a histogram of a numeric or date column from a DataFrame using plotly and display it in the browser.",
         "parameters": {
             "type": "object",
             "properties": {
@@ -547,7 +1258,7 @@ class PlotHistogram(Tool):
                 },
                 "column": {
                     "type": "string",
-                    "description": 'Column name to plot the histogram for (must be numeric)'
+                    "description": 'Column name to plot the histogram for (must be numeric or a date)'
                 },
                 "nbins": {
                     "type": "integer",
@@ -555,7 +1266,7 @@ class PlotHistogram(Tool):
                 },
                 "bin_size": {
                     "type": "number",
-                    "description": "Size of bins for the histogram (overrides nbins if provided)"
+                    "description": "Size of bins for the histogram, in days for date columns (overrides nbins if provided)"
                 }
             },
             "required": ["df", "column"]
@@ -576,16 +1287,16 @@ class PlotHistogram(Tool):
         if column not in pandas_df.columns:
             return f"Error: Column '{column}' not found in DataFrame '{df}'", None
 
-        if not pd.api.types.is_numeric_dtype(pandas_df[column]):
+        if not plotting.is_plottable_number(pandas_df[column]):
             return f"Error: Column '{column}' is not numeric", None
 
         try:
-            if bin_size is not None:
-                fig = go.Figure(data=[go.Histogram(x=pandas_df[column], xbins=dict(size=bin_size))])
-            else:
-                fig = px.histogram(pandas_df, x=column)
-            fig.show()
-            return f"Histogram for column '{column}' in DataFrame '{df}' has been plotted and opened in the browser.", None
+            # Binned here so plotly only receives the bins, however many rows there are
+            starts, widths, counts = plotting.histogram(pandas_df[column], nbins=nbins, bin_size=bin_size)
+            fig = go.Figure(data=[go.Bar(x=starts, y=counts, width=widths, offset=0)])
+            fig.update_layout(bargap=0, xaxis_title=column, yaxis_title="count")
+            where = plotting.show(fig, f"{df}_{column}_histogram")
+            return f"Histogram for column '{column}' in DataFrame '{df}' has been plotted and {where}.", None
         except Exception as e:
             return f"Error creating histogram: {str(e)}", None
 
@@ -648,18 +1359,32 @@ class PlotXY(Tool):
             return f"Error: Y column '{y_column}' must be numeric", None
 
         try:
-            plot_df = pandas_df[[x_column, y_column]].copy()
-            if plot_type == "line" and pd.api.types.is_numeric_dtype(plot_df[x_column]):
-                plot_df = plot_df.sort_values(by=x_column)
+            plot_df = pandas_df[[x_column, y_column]]
+            n_rows = len(plot_df)
+            x_is_number = plotting.is_plottable_number(plot_df[x_column])
 
+            if plot_type == "bar":
+                # Bars sharing an x stack into one, so summing them first draws the same chart
+                plot_df = plot_df.groupby(x_column, observed=True, sort=False)[y_column].sum().reset_index()
+            elif plot_type == "line":
+                if x_is_number:
+                    plot_df = plot_df.sort_values(by=x_column)
+                    keep = plotting.minmax_downsample(plotting.as_float(plot_df[x_column]), plotting.as_float(plot_df[y_column]))
+                    plot_df = plot_df.iloc[keep]
+            elif len(plot_df) > plotting.MAX_SCATTER_POINTS:
+                x = plotting.as_float(plot_df[x_column]) if x_is_number else plot_df[x_column].to_numpy()
+                plot_df = plot_df.iloc[plotting.thin_scatter(x, plotting.as_float(plot_df[y_column]))]
+
+            render_mode = 'webgl' if len(plot_df) > plotting.WEBGL_POINTS else 'auto'
             if plot_type == "scatter":
-                fig = px.scatter(plot_df, x=x_column, y=y_column)
+                fig = px.scatter(plot_df, x=x_column, y=y_column, render_mode=render_mode)
             elif plot_type == "bar":
                 fig = px.bar(plot_df, x=x_column, y=y_column)
             elif plot_type == "line":
-                fig = px.line(plot_df, x=x_column, y=y_column)
-            fig.show()
-            return f"{plot_type.capitalize()} plot of Y='{y_column}' vs X='{x_column}' from DataFrame '{df}' has been plotted and opened in the browser.", None
+                fig = px.line(plot_df, x=x_column, y=y_column, render_mode=render_mode)
+            where = plotting.show(fig, f"{df}_{y_column}_vs_{x_column}_{plot_type}")
+            reduced = f" {n_rows} rows were reduced to {len(plot_df)} points for drawing." if len(plot_df) < n_rows else ""
+            return f"{plot_type.capitalize()} plot of Y='{y_column}' vs X='{x_column}' from DataFrame '{df}' has been plotted and {where}.{reduced}", None
         except Exception as e:
             return f"Error creating plot: {str(e)}", None
 
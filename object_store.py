@@ -0,0 +1,114 @@
+# Memory-budgeted store for the data objects tools create during a session
+
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+import tracing
+from inat_cache import CACHE_DIR
+
+MEMORY_BUDGET = int(float(os.getenv("NATE_MEMORY_BUDGET_MB", "1024")) * 1024 * 1024)
+SPILL_DIR = os.path.join(CACHE_DIR, "spill")
+
+
+class ObjectStore(MutableMapping):
+    """ Dict of data objects by name that keeps the data held in memory under a byte budget.
+
+    When the objects in memory go over budget, the least recently used ones are
+    spilled to Arrow files on disk. An object keeps its name and summary while
+    spilled, and its data is read back (memory-mapped) the next time it is used.
+    Objects that can't spill (no spill method) always stay in memory, as does
+    the object being used even when it alone is over budget.
+    """
+
+    def __init__(self, budget=MEMORY_BUDGET, spill_dir=None):
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self.objects = {}
+        self.resident = OrderedDict()  # name -> bytes, least recently used first
+        self.lock = threading.RLock()
+        self.spills = 0
+        self.loads = 0
+
+    def __getitem__(self, name):
+        return self.objects[name]
+
+    def __setitem__(self, name, obj):
+        with self.lock:
+            if self.objects.get(name) is obj:
+                return
+            if name in self.objects:
+                self.forget(name)
+            self.objects[name] = obj
+            if hasattr(obj, 'spill'):
+                obj.store = self
+                # Frames restored from a snapshot arrive already on disk
+                if obj.is_loaded():
+                    self.resident[name] = obj.nbytes()
+                    self.enforce_budget(keep=name)
+
+    def __delitem__(self, name):
+        with self.lock:
+            self.forget(name)
+            del self.objects[name]
+
+    def __iter__(self):
+        return iter(self.objects)
+
+    def __len__(self):
+        return len(self.objects)
+
+    def forget(self, name):
+        obj = self.objects[name]
+        self.resident.pop(name, None)
+        if getattr(obj, 'store', None) is self:
+            obj.store = None
+            obj.discard_spill()
+
+    def touch(self, obj):
+        """ Marks obj as just used, reading its data back from disk first if it was spilled.
+        Returns the data, taken under the lock so another thread can't spill it first """
+        with self.lock:
+            if self.objects.get(obj.name) is not obj:
+                return obj._data
+            if obj.name not in self.resident:
+                with tracing.span("load", object=obj.name) as span:
+                    obj.load()
+                    self.resident[obj.name] = obj.nbytes()
+                    span.set(bytes=self.resident[obj.name])
+                self.loads += 1
+                self.enforce_budget(keep=obj.name)
+            else:
+                self.resident.move_to_end(obj.name)
+            return obj._data
+
+    def enforce_budget(self, keep=None):
+        while sum(self.resident.values()) > self.budget:
+            name = next((name for name in self.resident if name != keep), None)
+            if name is None:
+                return
+            with tracing.span("spill", object=name, bytes=self.resident.pop(name)):
+                self.objects[name].spill(self.spill_path(name))
+            self.spills += 1
+
+    def spill_path(self, name):
+        if self.spill_dir is None:
+            os.makedirs(SPILL_DIR, exist_ok=True)
+            self.spill_dir = tempfile.mkdtemp(prefix="session-", dir=SPILL_DIR)
+            atexit.register(shutil.rmtree, self.spill_dir, True)
+        safe_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in name)
+        return os.path.join(self.spill_dir, f"{safe_name}-{id(self.objects[name]):x}.arrow")
+
+    def memory_bytes(self):
+        with self.lock:
+            return sum(self.resident.values())
+
+    def stats(self):
+        with self.lock:
+            return {"objects": len(self.objects), "in_memory": len(self.resident),
+                    "bytes": sum(self.resident.values()), "budget": self.budget,
+                    "spills": self.spills, "loads": self.loads}
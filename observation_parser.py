@@ -0,0 +1,195 @@
+# Columnar parsing of /observations results into pandas DataFrames
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import tracing
+
+COLUMNS = [
+    'observation_id', 'verifiable', 'quality_grade', 'observed_on', 'created_at', 'updated_at',
+    'latitude', 'longitude', 'scientific_name', 'common_name', 'taxon_id', 'user_id', 'user_login',
+    'place_ids', 'wikipedia_url', 'default_photo_url', 'default_photo_attribution', 'all_photo_urls'
+]
+
+# Strings that repeat across many rows are stored once per value
+CATEGORY_COLUMNS = ['quality_grade', 'scientific_name', 'common_name', 'user_login', 'wikipedia_url']
+
+# Nested and mostly-unique fields are stored in Arrow buffers rather than as Python objects
+ARROW_COLUMNS = {
+    'place_ids': pa.list_(pa.int64()),
+    'all_photo_urls': pa.list_(pa.string()),
+    'default_photo_url': pa.string(),
+    'default_photo_attribution': pa.string(),
+}
+
+# API fields each column is built from, as dotted paths into the observation document
+COLUMN_FIELDS = {
+    'observation_id': ['id'],
+    'verifiable': ['quality_grade'],
+    'quality_grade': ['quality_grade'],
+    'observed_on': ['observed_on'],
+    'created_at': ['created_at'],
+    'updated_at': ['updated_at'],
+    'latitude': ['location'],
+    'longitude': ['location'],
+    'scientific_name': ['taxon.name'],
+    'common_name': ['taxon.preferred_common_name'],
+    'taxon_id': ['taxon.id'],
+    'user_id': ['user.id'],
+    'user_login': ['user.login'],
+    'place_ids': ['place_ids'],
+    'wikipedia_url': ['taxon.wikipedia_url'],
+    'default_photo_url': ['photos.url'],
+    'default_photo_attribution': ['photos.attribution'],
+    'all_photo_urls': ['photos.url'],
+}
+
+# Always kept: the merge key and high-water mark that refreshes rely on
+REQUIRED_COLUMNS = ['observation_id', 'updated_at']
+
+# Stored columns that derived columns are computed from
+DERIVED_COLUMN_INPUTS = {'attribution': ['user_login', 'observation_id']}
+
+VERIFIABLE_GRADES = {'research', 'needs_id'}
+
+
+def resolve_columns(columns=None):
+    """ Returns the stored columns needed to serve the requested ones (all of them by default) """
+    if columns is None:
+        return list(COLUMNS)
+    needed = set(REQUIRED_COLUMNS)
+    for col in columns:
+        needed.update(DERIVED_COLUMN_INPUTS.get(col, [col]))
+    return [col for col in COLUMNS if col in needed]
+
+
+def fields_param(columns):
+    """ Returns the v2 `fields` value, in RISON, that asks for only what columns are built from """
+    tree = {}
+    for col in columns:
+        for path in COLUMN_FIELDS[col]:
+            node = tree
+            *parents, leaf = path.split('.')
+            for key in parents:
+                node = node.setdefault(key, {})
+            node[leaf] = True
+    return to_rison(tree)
+
+
+def to_rison(tree):
+    return "(" + ",".join(f"{key}:!t" if value is True else f"{key}:{to_rison(value)}"
+                          for key, value in sorted(tree.items())) + ")"
+
+
+def parse_page(observations):
+    """ Parses one page of raw observation JSON into a dict of column buffers.
+
+    Only the buffers are kept, so the caller can drop the page as soon as this returns.
+    """
+    n = len(observations)
+    cols = {col: [None] * n for col in COLUMNS}
+    observation_id = np.empty(n, dtype=np.int64)
+    latitude = np.full(n, np.nan)
+    longitude = np.full(n, np.nan)
+
+    for i, obs in enumerate(observations):
+        # Safely extract nested data with a fallback
+        taxon = obs.get('taxon') or {}
+        user = obs.get('user') or {}
+        photos = obs.get('photos') or []
+        default_photo = photos[0] if photos else {}
+
+        observation_id[i] = obs['id']
+        cols['quality_grade'][i] = obs.get('quality_grade')
+        if obs.get('verifiable') is not None:
+            cols['verifiable'][i] = obs['verifiable']
+        elif obs.get('quality_grade') is not None:
+            cols['verifiable'][i] = obs['quality_grade'] in VERIFIABLE_GRADES
+        cols['observed_on'][i] = obs.get('observed_on')
+        cols['created_at'][i] = obs.get('created_at')
+        cols['updated_at'][i] = obs.get('updated_at')
+
+        # v1 results carry coordinates as a "lat,lon" string rather than separate fields
+        if obs.get('latitude') is not None:
+            latitude[i] = obs['latitude']
+            longitude[i] = obs['longitude']
+        elif obs.get('location'):
+            lat, lon = obs['location'].split(',')
+            latitude[i] = float(lat)
+            longitude[i] = float(lon)
+
+        cols['scientific_name'][i] = taxon.get('name')
+        cols['common_name'][i] = taxon.get('preferred_common_name')
+        cols['taxon_id'][i] = taxon.get('id')
+        cols['user_id'][i] = user.get('id')
+        cols['user_login'][i] = user.get('login')
+        cols['place_ids'][i] = obs.get('place_ids')
+        cols['wikipedia_url'][i] = taxon.get('wikipedia_url')
+        cols['default_photo_url'][i] = default_photo.get('url')
+        cols['default_photo_attribution'][i] = default_photo.get('attribution')
+        cols['all_photo_urls'][i] = [photo.get('url') for photo in photos]
+
+    cols['observation_id'] = observation_id
+    cols['latitude'] = latitude
+    cols['longitude'] = longitude
+    return cols
+
+
+def build_frame(chunks, n=None, columns=None):
+    """ Concatenates parsed page buffers (in order) into one typed DataFrame, keeping at most n rows
+    and only the given stored columns (all by default) """
+    with tracing.span("build_frame", pages=len(chunks)) as span:
+        df = assemble_frame(chunks, n, COLUMNS if columns is None else columns)
+        if tracing.enabled():
+            span.set(rows=len(df), columns=len(df.columns), bytes=int(df.memory_usage(deep=True).sum()))
+    return df
+
+
+def assemble_frame(chunks, n, columns):
+    data = {}
+    for col in columns:
+        parts = [chunk[col] for chunk in chunks]
+        if col in ('observation_id', 'latitude', 'longitude'):
+            data[col] = np.concatenate(parts) if parts else np.empty(0, dtype=np.int64 if col == 'observation_id' else np.float64)
+        else:
+            data[col] = [value for part in parts for value in part]
+        if n:
+            data[col] = data[col][:n]
+
+    df = pd.DataFrame(data, columns=columns)
+    if 'verifiable' in df.columns:
+        df['verifiable'] = df['verifiable'].astype('boolean')
+    for col in ('taxon_id', 'user_id'):
+        if col in df.columns:
+            df[col] = pd.array(df[col], dtype='Int64')
+
+    # Fixed formats let pandas skip per-element format inference
+    if 'observed_on' in df.columns:
+        df['observed_on'] = pd.to_datetime(df['observed_on'], format='%Y-%m-%d', errors='coerce')
+    for col in ('created_at', 'updated_at'):
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col], format='ISO8601', errors='coerce', utc=True)
+    return compact(df)
+
+
+def compact(df):
+    """ Converts an observation frame to the compact column layout. Safe to call on frames that are already compact """
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+        elif col in df.columns:
+            # Merged frames can carry categories that no longer appear
+            df[col] = df[col].cat.remove_unused_categories()
+    for col, arrow_type in ARROW_COLUMNS.items():
+        if col in df.columns and not isinstance(df[col].dtype, pd.ArrowDtype):
+            df[col] = pd.array(pa.array(df[col].tolist(), type=arrow_type), dtype=pd.ArrowDtype(arrow_type))
+    return df
+
+
+def attribution(df):
+    """ Builds the photo attribution string for each row from user_login and observation_id """
+    text = ("Photo by " + df['user_login'].astype(str) +
+            " via iNaturalist. View the observation: https://www.inaturalist.org/observations/" +
+            df['observation_id'].astype(str))
+    return text.where(df['user_login'].notna(), "")
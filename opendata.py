@@ -0,0 +1,282 @@
+# Local Parquet store of the iNaturalist open data export, for large queries without the API
+#
+#   python opendata.py ingest path/to/export   # the directory holding observations.csv, taxa.csv, ...
+#
+# The export (https://github.com/inaturalist/inaturalist-open-data) is a set of tab separated
+# files, optionally gzipped. Observations are streamed into Parquet files partitioned by iconic
+# taxon and year, so a query only opens the partitions its taxon and dates can fall in.
+
+import argparse
+import itertools
+import os
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import csv
+
+import taxonomy
+import tracing
+from inat_cache import CACHE_DIR
+from inat_client import get_json
+from spatial import geometry_bbox, points_in_geometry
+
+STORE_DIR = os.path.expanduser(os.getenv("NATE_OPENDATA_DIR", os.path.join(CACHE_DIR, "opendata")))
+BLOCK_SIZE = 64 * 1024 * 1024  # bytes of text parsed per batch while ingesting
+ROWS_PER_GROUP = 256 * 1024
+UNKNOWN_ICONIC = "unknown"  # partition of observations with no taxon or one outside every iconic group
+PHOTO_URL = "https://inaturalist-open-data.s3.amazonaws.com/photos/{photo_id}/medium.{extension}"
+
+# Columns kept from each export file, and their types. Files may lack some of them (older exports)
+OBSERVATION_TYPES = {
+    'observation_uuid': pa.string(),
+    'observer_id': pa.int64(),
+    'latitude': pa.float64(),
+    'longitude': pa.float64(),
+    'positional_accuracy': pa.float64(),
+    'taxon_id': pa.int64(),
+    'quality_grade': pa.string(),
+    'observed_on': pa.string(),  # parsed after reading, so a malformed date becomes null instead of an error
+    'license': pa.string(),
+}
+OBSERVER_TYPES = {'observer_id': pa.int64(), 'login': pa.string(), 'name': pa.string()}
+PHOTO_TYPES = {'photo_id': pa.int64(), 'observation_uuid': pa.string(), 'extension': pa.string(),
+               'license': pa.string(), 'position': pa.int64()}
+
+
+def export_file(export_dir, name):
+    """ Returns the path of name.csv (or name.csv.gz) in an export directory, or None """
+    for file_name in (f"{name}.csv", f"{name}.csv.gz"):
+        path = os.path.join(export_dir, file_name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def read_batches(path, types):
+    """ Yields record batches of the columns of a tab separated export file that appear in types """
+    with pa.input_stream(path, compression='detect') as stream:
+        header = stream.read(1 << 16).split(b"\n", 1)[0].decode().rstrip("\r").split("\t")
+    columns = [col for col in header if col in types]
+    reader = csv.open_csv(
+        pa.input_stream(path, compression='detect'),
+        read_options=csv.ReadOptions(block_size=BLOCK_SIZE),
+        parse_options=csv.ParseOptions(delimiter="\t", quote_char=False),
+        convert_options=csv.ConvertOptions(column_types={col: types[col] for col in columns}, include_columns=columns),
+    )
+    for batch in reader:
+        yield batch
+
+
+def observation_batches(path, index):
+    """ Yields observation batches with observed_on as a date and the partition columns added """
+    for batch in read_batches(path, OBSERVATION_TYPES):
+        table = pa.Table.from_batches([batch])
+        if 'observed_on' in table.column_names:
+            observed_on = pc.strptime(table['observed_on'], format='%Y-%m-%d', unit='s', error_is_null=True)
+            table = table.set_column(table.schema.get_field_index('observed_on'), 'observed_on', pc.cast(observed_on, pa.date32()))
+            year = pc.cast(pc.year(table['observed_on']), pa.int16())
+        else:
+            year = pa.nulls(len(table), pa.int16())
+        iconic = index.iconic_names(table['taxon_id'].to_numpy(zero_copy_only=False))
+        iconic[pd.isna(iconic)] = UNKNOWN_ICONIC
+        table = table.append_column('iconic', pa.array(iconic, pa.string())).append_column('year', year)
+        yield from table.to_batches()
+
+
+def ingest(export_dir, store_dir=None):
+    """ Loads an open data export into the store, replacing any partitions it covers.
+    Returns {file: rows} for the files ingested """
+    store_dir = store_dir or STORE_DIR
+    os.makedirs(store_dir, exist_ok=True)
+    counts = {}
+
+    # Taxa first: observations are partitioned by the iconic group their taxon belongs to
+    index = taxonomy.get_index()
+    taxa_path = export_file(export_dir, "taxa")
+    if taxa_path is not None:
+        with tracing.span("ingest", file="taxa"):
+            index.load_open_data(taxa_path)
+        counts['taxa'] = len(index)
+
+    observers_path = export_file(export_dir, "observers")
+    if observers_path is not None:
+        with tracing.span("ingest", file="observers"):
+            table = pa.Table.from_batches(list(read_batches(observers_path, OBSERVER_TYPES)))
+            pq.write_table(table, os.path.join(store_dir, "observers.parquet"))
+        counts['observers'] = len(table)
+
+    observations_path = export_file(export_dir, "observations")
+    if observations_path is not None:
+        with tracing.span("ingest", file="observations") as span:
+            counts['observations'] = write_partitioned(
+                observation_batches(observations_path, index), os.path.join(store_dir, "observations"), ['iconic', 'year'])
+            span.set(rows=counts['observations'])
+
+    # Only each observation's first photo is kept; the full table is several times larger than the observations
+    photos_path = export_file(export_dir, "photos")
+    if photos_path is not None:
+        with tracing.span("ingest", file="photos") as span:
+            first_photos = (batch.filter(pc.equal(batch['position'], 0)) for batch in read_batches(photos_path, PHOTO_TYPES))
+            counts['photos'] = write_partitioned(first_photos, os.path.join(store_dir, "photos"), None)
+            span.set(rows=counts['photos'])
+    return counts
+
+
+def write_partitioned(batches, path, partition_by):
+    """ Streams batches into a Parquet dataset at path, replacing the partitions they write to. Returns the row count """
+    rows = 0
+
+    def counted(batches):
+        nonlocal rows
+        for batch in batches:
+            rows += len(batch)
+            yield batch
+
+    # The first batch gives the schema
+    first = next(batches, None)
+    if first is None:
+        return 0
+    ds.write_dataset(
+        counted(itertools.chain([first], batches)), path, schema=first.schema, format='parquet',
+        partitioning=partition_by, partitioning_flavor='hive' if partition_by else None,
+        basename_template=f"part-{int(time.time())}-{{i}}.parquet",
+        existing_data_behavior='delete_matching',
+        # A minimum group size would hold rows back in every open partition (iconic group x year, about
+        # a thousand) until each filled a group, i.e. most of the export. Unpartitioned writes buffer one group
+        min_rows_per_group=0 if partition_by else ROWS_PER_GROUP, max_rows_per_group=ROWS_PER_GROUP,
+    )
+    return rows
+
+
+def has_store(store_dir=None):
+    return os.path.isdir(os.path.join(store_dir or STORE_DIR, "observations"))
+
+
+def query(taxon_id=None, place_id=None, d1=None, d2=None, quality_grade=None, photos=False, limit=None, store_dir=None):
+    """ Returns a pandas DataFrame of the stored observations of taxon_id (and every taxon below it)
+    inside place_id, observed between d1 and d2 (YYYY-MM-DD, inclusive), newest first. At least
+    one of taxon_id and place_id is required.
+
+    Partitions are pruned by iconic group and year, the other conditions are pushed down into
+    the Parquet scan, and only the place's bounding box is scanned before the exact boundary
+    check. With a limit, years are scanned newest first and the scan stops at the first year
+    that brings the total to the limit. The place's boundary comes from the API the first
+    time and from the response cache after. """
+    if taxon_id is None and place_id is None:
+        raise ValueError("taxon_id or place_id is required; the whole store is too large to load")
+    store_dir = store_dir or STORE_DIR
+    dataset = ds.dataset(os.path.join(store_dir, "observations"), format='parquet', partitioning='hive')
+    condition = ds.scalar(True)
+    index = taxonomy.get_index()
+
+    if taxon_id is not None:
+        ids = index.descendant_ids(int(taxon_id))
+        if len(ids) == 0:
+            raise ValueError(f"Taxon {taxon_id} isn't in the local taxonomy; ingest the export's taxa.csv")
+        groups = [UNKNOWN_ICONIC if group is None else group for group in index.iconic_groups_under(int(taxon_id))]
+        condition &= ds.field('iconic').isin(groups) & ds.field('taxon_id').isin(pa.array(ids))
+
+    if d1 is not None:
+        start = pd.Timestamp(d1)
+        condition &= (ds.field('year') >= start.year) & (ds.field('observed_on') >= pa.scalar(start.date(), pa.date32()))
+    if d2 is not None:
+        end = pd.Timestamp(d2)
+        condition &= (ds.field('year') <= end.year) & (ds.field('observed_on') <= pa.scalar(end.date(), pa.date32()))
+    if quality_grade is not None:
+        condition &= ds.field('quality_grade') == quality_grade
+
+    geometry = None
+    if place_id is not None:
+        geometry = place_geometry(place_id)
+        min_lat, min_lon, max_lat, max_lon = geometry_bbox(geometry)
+        condition &= ((ds.field('latitude') >= min_lat) & (ds.field('latitude') <= max_lat) &
+                      (ds.field('longitude') >= min_lon) & (ds.field('longitude') <= max_lon))
+
+    columns = [col for col in OBSERVATION_TYPES if col in dataset.schema.names]
+    # Without a limit every matching year is read in one scan
+    year_conditions = [condition]
+    if limit:
+        years = {ds.get_partition_keys(fragment.partition_expression).get('year')
+                 for fragment in dataset.get_fragments(filter=condition)}
+        # Undated observations sort last, so their partition is read last
+        if years:
+            year_conditions = [condition & (ds.field('year') == year) for year in sorted(years - {None}, reverse=True)]
+            if None in years:
+                year_conditions.append(condition & ds.field('year').is_null())
+
+    frames = []
+    rows = 0
+    with tracing.span("scan", taxon_id=taxon_id, place_id=place_id) as span:
+        for year_condition in year_conditions:
+            df = dataset.to_table(columns=columns, filter=year_condition).to_pandas(date_as_object=False)
+            if geometry is not None:
+                df = df[points_in_geometry(df['latitude'].to_numpy(), df['longitude'].to_numpy(), geometry)]
+            frames.append(df)
+            rows += len(df)
+            if limit and rows >= limit:
+                break
+        span.set(rows=rows, scans=len(frames))
+    df = pd.concat(frames, ignore_index=True)
+    df = df.sort_values('observed_on', ascending=False, kind='stable', ignore_index=True)
+    if limit:
+        df = df.head(limit)
+    return finish_frame(df, index, store_dir, photos)
+
+
+def finish_frame(df, index, store_dir, photos):
+    """ Names the columns like GetObservations does and adds names looked up from the other tables """
+    df = df.rename(columns={'observer_id': 'user_id'})
+    df['taxon_id'] = pd.array(df['taxon_id'], dtype='Int64')
+    df['user_id'] = pd.array(df['user_id'], dtype='Int64')
+    index.build()
+    names = pd.Series({i: index.taxa[i]['name'] for i in df['taxon_id'].dropna().unique() if i in index.taxa}, dtype=object)
+    df.insert(df.columns.get_loc('taxon_id') + 1, 'scientific_name', pd.Categorical(df['taxon_id'].map(names)))
+
+    observers_path = os.path.join(store_dir, "observers.parquet")
+    if os.path.exists(observers_path) and len(df):
+        observers = pq.read_table(observers_path, columns=['observer_id', 'login'],
+                                  filters=[('observer_id', 'in', df['user_id'].dropna().unique().tolist())]).to_pandas()
+        logins = pd.Series(observers['login'].to_numpy(), index=observers['observer_id'])
+        df.insert(df.columns.get_loc('user_id') + 1, 'user_login', pd.Categorical(df['user_id'].map(logins)))
+
+    photos_dir = os.path.join(store_dir, "photos")
+    if photos and os.path.isdir(photos_dir) and len(df):
+        found = ds.dataset(photos_dir, format='parquet').to_table(
+            columns=['observation_uuid', 'photo_id', 'extension'],
+            filter=ds.field('observation_uuid').isin(pa.array(df['observation_uuid'].unique()))).to_pandas()
+        urls = pd.Series([PHOTO_URL.format(photo_id=p, extension=e) for p, e in zip(found['photo_id'], found['extension'])],
+                         index=found['observation_uuid'], dtype=object)
+        df['default_photo_url'] = pd.arrays.ArrowExtensionArray(pa.array(df['observation_uuid'].map(urls), pa.string()))
+
+    for col in ('quality_grade', 'license'):
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    return df
+
+
+def place_geometry(place_id):
+    """ Returns a place's boundary as GeoJSON """
+    results = get_json(f"/places/{int(place_id)}")['results']
+    if not results or not results[0].get('geometry_geojson'):
+        raise ValueError(f"Place {place_id} has no boundary")
+    return results[0]['geometry_geojson']
+
+
+def main(args):
+    counts = ingest(args.export_dir, args.store)
+    for name, rows in counts.items():
+        print(f"{name}: {rows} rows")
+    print(f"Store at {args.store or STORE_DIR}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the iNaturalist open data export into the local store.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    ingest_parser = subparsers.add_parser('ingest', help='load an export directory')
+    ingest_parser.add_argument('export_dir', type=str, help='directory holding observations.csv, taxa.csv, observers.csv and photos.csv')
+    ingest_parser.add_argument('--store', type=str, default=None, help=f'store directory (default {STORE_DIR})')
+    main(parser.parse_args())
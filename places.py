@@ -0,0 +1,120 @@
+# Persistent place id -> name cache, so place ancestries resolve in at most one request
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+
+from inat_cache import CACHE_DIR
+from inat_client import get_json
+
+PLACE_TTL = 90 * 24 * 3600  # seconds before a cached place is looked up again
+PLACES_PER_REQUEST = 500  # the most /places/{ids} returns in one response
+
+FIELDS = ['name', 'display_name', 'place_type', 'admin_level', 'bbox']
+
+
+class PlaceCache:
+    """ Names, types and bounding boxes of places by id, kept in SQLite across sessions.
+
+    Places are added from any response that carries them (such as autocomplete
+    results), and the ids still unknown are fetched together in one /places/{ids}
+    request. Geometries are not kept, only the bounding box.
+    """
+
+    def __init__(self, path=None, ttl=PLACE_TTL):
+        if path is None:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            path = os.path.join(CACHE_DIR, "places.sqlite")
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS places ("
+            "id INTEGER PRIMARY KEY, name TEXT, display_name TEXT, place_type INTEGER, "
+            "admin_level INTEGER, bbox TEXT, fetched_at REAL)"
+        )
+        self.conn.commit()
+
+    def add(self, places):
+        """ Stores places in the shape the API returns them """
+        now = time.time()
+        rows = [
+            (place['id'], place.get('name'), place.get('display_name'), place.get('place_type'),
+             place.get('admin_level'), json.dumps(bbox(place)), now)
+            for place in places if place and place.get('id') is not None
+        ]
+        if not rows:
+            return
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO places VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.commit()
+
+    def get_many(self, ids):
+        """ Returns {id: place dict} for the ids that are cached and fresh """
+        ids = list({int(i) for i in ids})
+        if not ids:
+            return {}
+        found = {}
+        with self.lock:
+            # Under SQLite's default limit of 999 bound variables per statement
+            for i in range(0, len(ids), 900):
+                chunk = ids[i:i + 900]
+                rows = self.conn.execute(
+                    f"SELECT id, {', '.join(FIELDS)} FROM places "
+                    f"WHERE fetched_at > ? AND id IN ({', '.join('?' * len(chunk))})",
+                    [time.time() - self.ttl] + chunk,
+                ).fetchall()
+                for row in rows:
+                    place = dict(zip(['id'] + FIELDS, row))
+                    place['bbox'] = json.loads(place['bbox'])
+                    found[place['id']] = place
+        return found
+
+    def resolve(self, ids):
+        """ Returns {id: place dict} for ids, fetching every uncached one in a single batched
+        request. Ids that can't be looked up (e.g. offline) are left out """
+        found = self.get_many(ids)
+        missing = sorted({int(i) for i in ids} - set(found))
+        for i in range(0, len(missing), PLACES_PER_REQUEST):
+            batch = missing[i:i + PLACES_PER_REQUEST]
+            try:
+                # The response carries full geometries, so it skips the response cache and only the compact fields are kept
+                results = get_json('/places/' + ",".join(str(place_id) for place_id in batch), use_cache=False)['results']
+            except (requests.exceptions.RequestException, ValueError, KeyError):
+                break
+            # Ids the API doesn't know are stored without a name, so they aren't asked for again
+            returned = {place['id'] for place in results}
+            self.add(results + [{'id': place_id} for place_id in batch if place_id not in returned])
+            found.update(self.get_many(batch))
+        return found
+
+
+def bbox(place):
+    """ Returns [min lon, min lat, max lon, max lat] from a place's bounding box GeoJSON, or None """
+    if place.get('bbox') is not None:
+        return place['bbox']
+    geojson = place.get('bounding_box_geojson')
+    if not geojson or not geojson.get('coordinates'):
+        return None
+    points = [point for ring in geojson['coordinates'] for point in ring]
+    lons = [point[0] for point in points]
+    lats = [point[1] for point in points]
+    return [min(lons), min(lats), max(lons), max(lats)]
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_place_cache():
+    """ Returns the process-wide place cache, opening it on first use """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = PlaceCache()
+        return _cache
@@ -0,0 +1,135 @@
+# Reducing large columns to what a plot can show, and showing or saving figures
+
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+PLOT_DIR = os.getenv("NATE_PLOT_DIR")  # when set, figures are saved here instead of opened in a browser
+PLOT_FORMAT = os.getenv("NATE_PLOT_FORMAT", "html")  # "html", or "png" (needs the kaleido package)
+PLOT_FORMATS = ("html", "png")
+MAX_HISTOGRAM_BINS = 5000  # a bin_size giving more bins than this is refused
+MAX_LINE_POINTS = 4000  # a line keeps the min and max of this many / 2 x buckets
+MAX_SCATTER_POINTS = 20000  # past this a scatter keeps one point per cell of a SCATTER_GRID square grid
+SCATTER_GRID = 150  # at most 22,500 points, close to MAX_SCATTER_POINTS; dense areas still read as solid
+WEBGL_POINTS = 5000  # scatter and line traces with more points than this are drawn with WebGL
+
+
+def configure(plot_dir=None, plot_format="html"):
+    global PLOT_DIR, PLOT_FORMAT
+    assert plot_format in PLOT_FORMATS, f"plot_format must be one of {PLOT_FORMATS}"
+    PLOT_DIR = plot_dir
+    PLOT_FORMAT = plot_format
+
+
+def is_plottable_number(series):
+    """ True for columns that can be binned: numbers (but not booleans) and dates """
+    dtype = series.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return False
+    return pd.api.types.is_numeric_dtype(dtype) or pd.api.types.is_datetime64_any_dtype(dtype)
+
+
+def as_float(series):
+    """ Returns a float numpy array of a numeric or date column (dates in the column's time unit
+    since the epoch) with NaN for missing values """
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        values = series.array.asi8.astype(float)
+        values[series.isna().to_numpy()] = np.nan
+        return values
+    return series.to_numpy(dtype=float, na_value=np.nan)
+
+
+def from_float(values, like):
+    """ Turns as_float values back into the type of the column they came from, for axis labels """
+    if pd.api.types.is_datetime64_any_dtype(like.dtype):
+        # Zone-aware columns come back as naive UTC times
+        return pd.to_datetime(values.astype(np.int64), unit=like.dt.unit)
+    return values
+
+
+def histogram(series, nbins=50, bin_size=None):
+    """ Returns (left edges, widths, counts) for a numeric or date column, ignoring missing values.
+    Widths are in axis units, which plotly takes in milliseconds for dates """
+    values = as_float(series)
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return from_float(np.zeros(0), series), np.zeros(0), np.zeros(0, dtype=np.int64)
+    lo, hi = values.min(), values.max()
+    is_date = pd.api.types.is_datetime64_any_dtype(series.dtype)
+    if bin_size is not None and not bin_size > 0:
+        raise ValueError(f"bin_size must be positive, got {bin_size}")
+    if bin_size is None and not 1 <= nbins <= MAX_HISTOGRAM_BINS:
+        raise ValueError(f"nbins must be between 1 and {MAX_HISTOGRAM_BINS}, got {nbins}")
+    if hi == lo:
+        # One value: a single bin a day (or 1) wide, centred on it
+        width = pd.Timedelta(days=1) / pd.Timedelta(1, unit=series.dt.unit) if is_date else 1.0
+        edges = np.array([lo - width / 2, lo + width / 2])
+    elif bin_size is not None:
+        if is_date:
+            bin_size = pd.Timedelta(days=bin_size) / pd.Timedelta(1, unit=series.dt.unit)  # given in days for dates
+        if (hi - lo) / bin_size > MAX_HISTOGRAM_BINS:
+            raise ValueError(f"bin_size is too small: it makes more than {MAX_HISTOGRAM_BINS} bins; use a larger bin_size or nbins")
+        edges = np.arange(lo, hi + bin_size, bin_size)
+        if len(edges) < 2:
+            edges = np.array([lo, lo + bin_size])
+    else:
+        edges = np.histogram_bin_edges(values, bins=nbins)
+    counts, edges = np.histogram(values, bins=edges)
+    widths = np.diff(edges)
+    if is_date:
+        widths = widths * (pd.Timedelta(1, unit=series.dt.unit) / pd.Timedelta(milliseconds=1))
+    return from_float(edges[:-1], series), widths, counts
+
+
+def minmax_downsample(x, y, n_points=MAX_LINE_POINTS):
+    """ Returns positions that keep the lowest and highest y in each of n_points / 2 equal-count
+    buckets of rows (already ordered by x), so a downsampled line keeps every peak and trough """
+    n = len(y)
+    if n <= n_points:
+        return np.arange(n)
+    starts = np.linspace(0, n, n_points // 2, endpoint=False).astype(np.int64)
+    low_filled = np.where(np.isnan(y), np.inf, y)
+    high_filled = np.where(np.isnan(y), -np.inf, y)
+    bucket = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, n)))
+    is_low = low_filled == np.minimum.reduceat(low_filled, starts)[bucket]
+    is_high = high_filled == np.maximum.reduceat(high_filled, starts)[bucket]
+    # First low and first high of each bucket, in x order
+    low_pos = np.flatnonzero(is_low)
+    low_pos = low_pos[np.unique(bucket[low_pos], return_index=True)[1]]
+    high_pos = np.flatnonzero(is_high)
+    high_pos = high_pos[np.unique(bucket[high_pos], return_index=True)[1]]
+    return np.unique(np.concatenate([low_pos, high_pos]))
+
+
+def thin_scatter(x, y, grid=SCATTER_GRID):
+    """ Returns positions of one point per cell of a grid x grid raster, which draws the same
+    picture as every point once there are more points than pixels """
+    cells = []
+    for values in (x, y):
+        if values.dtype.kind == 'f':
+            lo, hi = np.nanmin(values), np.nanmax(values)
+            scaled = (values - lo) / (hi - lo) * (grid - 1) if hi > lo else np.zeros(len(values))
+            cells.append(np.nan_to_num(scaled, nan=-1).astype(np.int64) + 1)
+        else:
+            cells.append(pd.factorize(values)[0].astype(np.int64) + 1)
+    cell_ids = cells[0] * (cells[1].max() + 1) + cells[1]
+    return np.sort(np.unique(cell_ids, return_index=True)[1])
+
+
+def show(fig, name):
+    """ Opens fig in the browser, or saves it under PLOT_DIR when running headless.
+    Returns a phrase saying where the plot went """
+    if PLOT_DIR is None:
+        fig.show()
+        return "opened in the browser"
+    os.makedirs(PLOT_DIR, exist_ok=True)
+    safe_name = re.sub(r'[^A-Za-z0-9_-]+', '_', name).strip('_') or "plot"
+    path = os.path.join(PLOT_DIR, f"{safe_name}.{PLOT_FORMAT}")
+    if PLOT_FORMAT == "png":
+        fig.write_image(path)
+    else:
+        # The plotly library is loaded from a CDN so each file is only the figure's data
+        fig.write_html(path, include_plotlyjs='cdn')
+    return f"saved to {path}"
@@ -0,0 +1,136 @@
+# Record/replay stand-ins for Gemini and the iNaturalist API, so Nate can run offline
+
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from google.genai import types
+
+from inat_cache import normalize_params
+
+LLM_FIXTURE = "llm.json"
+HTTP_FIXTURE = "http.jsonl"
+
+
+class RecordingLLM:
+    """ Wraps an LLM and saves every response it returns to a fixture file """
+
+    def __init__(self, llm, fixture_dir):
+        self.llm = llm
+        self.path = os.path.join(fixture_dir, LLM_FIXTURE)
+        self.responses = []
+
+    def call(self, contents):
+        content, usage = self.llm.call(contents)
+        self.save(content, usage)
+        return content, usage
+
+    async def call_stream(self, contents, usage=None):
+        usage = {} if usage is None else usage
+        parts = []
+        async for part in self.llm.call_stream(contents, usage):
+            parts.append(part)
+            yield part
+        self.save(types.Content(role="model", parts=parts), usage)
+
+    def count_tokens(self, contents):
+        return self.llm.count_tokens(contents)
+
+    def save(self, content, usage):
+        self.responses.append({"content": content.model_dump(mode="json", exclude_none=True), "usage": dict(usage)})
+        with open(self.path, 'w') as f:
+            json.dump(self.responses, f, indent=1)
+
+
+class ReplayLLM:
+    """ Offline LLM substitute that returns recorded responses in order """
+
+    def __init__(self, fixture_dir):
+        with open(os.path.join(fixture_dir, LLM_FIXTURE), 'r') as f:
+            self.responses = json.load(f)
+        self.position = 0
+
+    def next_response(self):
+        if self.position >= len(self.responses):
+            raise RuntimeError("Replay ran out of recorded LLM responses; re-record the fixture")
+        response = self.responses[self.position]
+        self.position += 1
+        return types.Content.model_validate(response["content"]), dict(response["usage"])
+
+    def call(self, contents):
+        return self.next_response()
+
+    async def call_stream(self, contents, usage=None):
+        content, recorded_usage = self.next_response()
+        if usage is not None:
+            usage.update(recorded_usage)
+        for part in content.parts or []:
+            yield part
+
+    def count_tokens(self, contents):
+        return sum(len(json.dumps(c, default=str)) for c in contents) // 4
+
+
+class HTTPRecorder:
+    """ inat_client.recorder hook that appends every API response to a fixture file """
+
+    def __init__(self, fixture_dir):
+        self.path = os.path.join(fixture_dir, HTTP_FIXTURE)
+        self.lock = threading.Lock()
+        open(self.path, 'w').close()
+
+    def __call__(self, url, params, response):
+        record = {
+            "path": urlsplit(url).path,
+            "params": normalize_params(params),
+            "status": response.status_code,
+            "body": response.text,
+        }
+        with self.lock, open(self.path, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+
+class FixtureServer:
+    """ Local HTTP stand-in for api.inaturalist.org that serves recorded responses.
+
+    Point the tools at it with inat_client.API_ROOT = server.url (or NATE_API_ROOT).
+    Requests that were never recorded get a 404.
+    """
+
+    def __init__(self, fixture_dir, port=0):
+        self.responses = {}
+        with open(os.path.join(fixture_dir, HTTP_FIXTURE), 'r') as f:
+            for line in f:
+                record = json.loads(line)
+                key = (record["path"], tuple(map(tuple, record["params"])))
+                self.responses[key] = (record["status"], record["body"].encode())
+
+        responses = self.responses
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                key = (url.path, tuple(map(tuple, normalize_params(dict(parse_qsl(url.query))))))
+                status, body = responses.get(key, (404, b'{"error": "not recorded"}'))
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
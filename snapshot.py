@@ -0,0 +1,97 @@
+# Save a session's data objects and chat history to disk, and restore them at startup
+
+import hashlib
+import json
+import os
+import shutil
+
+import pandas as pd
+from google.genai import types
+
+from data_objects import DataFrame, ObservationDataFrame
+
+MANIFEST = "manifest.json"
+HISTORY = "history.json"
+OBJECT_CLASSES = {cls.__name__: cls for cls in (DataFrame, ObservationDataFrame)}
+
+
+class Snapshot:
+    """ A session saved in a directory: one Arrow file per DataFrame, the chat history,
+    and a manifest listing each frame's class, constructor arguments and file.
+
+    Restoring reads only the manifest and each file's metadata; a frame's data is
+    memory-mapped the first time a tool uses it. Saving again only writes frames
+    that are new or were replaced since the last save.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.saved = {}  # name -> the object last saved under that name
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, MANIFEST))
+
+    def save(self, objs, history=None):
+        os.makedirs(self.path, exist_ok=True)
+        entries = []
+        for name, obj in list(objs.items()):
+            if type(obj).__name__ not in OBJECT_CLASSES:
+                continue
+            file_name = snapshot_file_name(name)
+            path = os.path.join(self.path, file_name)
+            if self.saved.get(name) is not obj:
+                if obj.is_loaded():
+                    obj.write_arrow(path)
+                else:
+                    shutil.copyfile(obj.arrow_path, path + ".tmp")
+                    os.replace(path + ".tmp", path)
+                self.saved[name] = obj
+            entries.append({"name": name, "class": type(obj).__name__, "file": file_name,
+                            "args": obj.snapshot_metadata()})
+
+        # Frames deleted since the last save
+        kept = {entry["file"] for entry in entries}
+        for file_name in os.listdir(self.path):
+            if file_name.endswith(".arrow") and file_name not in kept:
+                os.remove(os.path.join(self.path, file_name))
+        self.saved = {name: obj for name, obj in self.saved.items() if name in objs}
+
+        if history is not None:
+            messages = [message_json(m) for m in history.messages[history.n_pinned:]]
+            write_json(os.path.join(self.path, HISTORY), messages)
+        write_json(os.path.join(self.path, MANIFEST), {"objects": entries})
+
+    def restore(self, objs, history=None):
+        """ Adds the saved frames to objs, still on disk, and the saved chat to history if given.
+        Returns the names of the restored frames """
+        with open(os.path.join(self.path, MANIFEST), 'r') as f:
+            manifest = json.load(f)
+        for entry in manifest["objects"]:
+            obj = OBJECT_CLASSES[entry["class"]](entry["name"], pd.DataFrame(), **entry["args"])
+            obj.attach_arrow(os.path.join(self.path, entry["file"]), owned=False)
+            objs[obj.name] = obj
+            self.saved[obj.name] = obj
+
+        history_path = os.path.join(self.path, HISTORY)
+        if history is not None and os.path.exists(history_path):
+            with open(history_path, 'r') as f:
+                # The pinned system prompt is always the current one, not the saved one
+                history.messages[history.n_pinned:] = [types.Content.model_validate(m) for m in json.load(f)]
+        return [entry["name"] for entry in manifest["objects"]]
+
+
+def snapshot_file_name(name):
+    safe_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in name)
+    return f"{safe_name}-{hashlib.sha1(name.encode()).hexdigest()[:8]}.arrow"
+
+
+def message_json(message):
+    if isinstance(message, dict):
+        return message
+    return message.model_dump(mode="json", exclude_none=True)
+
+
+def write_json(path, value):
+    with open(path + ".tmp", 'w') as f:
+        json.dump(value, f, default=str)
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,175 @@
+# Uniform latitude/longitude grid index for box, radius and nearest-point queries over a frame's coordinates
+
+import math
+
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180  # along a meridian, about 111 km
+CELL_DEGREES = 0.1  # grid cell size of the index, about 11 km north to south
+MAX_DISTANCE_KM = math.pi * EARTH_RADIUS_KM  # half way round the earth; no point is further
+
+
+class SpatialIndex:
+    """ Positions of the rows of a frame bucketed into a uniform latitude/longitude grid.
+
+    Rows are sorted by cell id (grid row * columns + grid column), so the rows in
+    a run of neighbouring cells along one grid row are a single slice of the sorted
+    arrays. A box query takes one slice per grid row it spans, then checks the
+    exact coordinates of only those candidates. Rows without coordinates are left out.
+    """
+
+    def __init__(self, latitude, longitude, cell=CELL_DEGREES):
+        self.cell = cell
+        self.n_lat = math.ceil(180 / cell)
+        self.n_lon = math.ceil(360 / cell)
+        latitude = np.asarray(latitude, dtype=float)
+        longitude = np.asarray(longitude, dtype=float)
+        positions = np.flatnonzero(~np.isnan(latitude) & ~np.isnan(longitude))
+        cells = self.cell_ids(latitude[positions], longitude[positions])
+        order = np.argsort(cells, kind='stable')
+        self.cells = cells[order]
+        self.rows = positions[order]
+        self.lat = latitude[self.rows]
+        self.lon = longitude[self.rows]
+
+    def grid_row(self, latitude):
+        return np.clip(np.floor((np.asarray(latitude) + 90) / self.cell).astype(np.int64), 0, self.n_lat - 1)
+
+    def grid_col(self, longitude):
+        return np.clip(np.floor((np.asarray(longitude) + 180) / self.cell).astype(np.int64), 0, self.n_lon - 1)
+
+    def cell_ids(self, latitude, longitude):
+        return self.grid_row(latitude) * self.n_lon + self.grid_col(longitude)
+
+    def box_slots(self, min_lat, min_lon, max_lat, max_lon):
+        """ Returns positions in the sorted arrays of the points inside a box. A box with
+        min_lon > max_lon crosses the antimeridian """
+        if min_lon > max_lon:
+            return np.concatenate([self.box_slots(min_lat, min_lon, max_lat, 180.0),
+                                   self.box_slots(min_lat, -180.0, max_lat, max_lon)])
+        grid_rows = np.arange(self.grid_row(min_lat), self.grid_row(max_lat) + 1)
+        starts = np.searchsorted(self.cells, grid_rows * self.n_lon + self.grid_col(min_lon), side='left')
+        ends = np.searchsorted(self.cells, grid_rows * self.n_lon + self.grid_col(max_lon), side='right')
+        slots = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)] + [np.zeros(0, dtype=np.int64)])
+        lat, lon = self.lat[slots], self.lon[slots]
+        return slots[(lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)]
+
+    def in_box(self, min_lat, min_lon, max_lat, max_lon, mask=None):
+        """ Returns the row positions of the points inside a box, in row order. Only rows
+        where the boolean row mask is True are considered, if one is given """
+        rows = self.rows[self.box_slots(min_lat, min_lon, max_lat, max_lon)]
+        if mask is not None:
+            rows = rows[mask[rows]]
+        return np.sort(rows)
+
+    def within(self, latitude, longitude, radius_km, mask=None):
+        """ Returns (row positions, distances in km) of the points within radius_km of a point, nearest first """
+        slots = self.box_slots(*radius_box(latitude, longitude, radius_km))
+        if mask is not None:
+            slots = slots[mask[self.rows[slots]]]
+        distances = haversine_km(latitude, longitude, self.lat[slots], self.lon[slots])
+        keep = distances <= radius_km
+        slots, distances = slots[keep], distances[keep]
+        order = np.argsort(distances, kind='stable')
+        return self.rows[slots[order]], distances[order]
+
+    def nearest(self, latitude, longitude, k, mask=None):
+        """ Returns (row positions, distances in km) of the k points nearest a point, nearest first """
+        # Search a circle a few cells across, growing it until it holds k points
+        radius_km = 2 * self.cell * KM_PER_DEGREE
+        while True:
+            rows, distances = self.within(latitude, longitude, min(radius_km, MAX_DISTANCE_KM), mask)
+            if len(rows) >= k or radius_km >= MAX_DISTANCE_KM:
+                return rows[:k], distances[:k]
+            radius_km *= 4
+
+
+def radius_box(latitude, longitude, radius_km):
+    """ Returns (min lat, min lon, max lat, max lon) of a box holding every point within radius_km """
+    dlat = radius_km / KM_PER_DEGREE
+    min_lat, max_lat = max(latitude - dlat, -90.0), min(latitude + dlat, 90.0)
+    # Near a pole, or for a circle reaching past one, every longitude is in range
+    cos_lat = math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+    if max_lat >= 90 or min_lat <= -90 or radius_km / KM_PER_DEGREE / max(cos_lat, 1e-12) >= 180:
+        return min_lat, -180.0, max_lat, 180.0
+    dlon = dlat / cos_lat
+    min_lon = (longitude - dlon + 180) % 360 - 180
+    max_lon = (longitude + dlon + 180) % 360 - 180
+    return min_lat, min_lon, max_lat, max_lon
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """ Great-circle distance in km, vectorized over numpy arrays """
+    lat1, lon1, lat2, lon2 = (np.radians(v) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def grid_counts(latitude, longitude, cell_km):
+    """ Returns a DataFrame of cell_lat, cell_lon (cell centres) and count for square cells about
+    cell_km on a side at the points' middle latitude, most populated cells first """
+    latitude = np.asarray(latitude, dtype=float)
+    longitude = np.asarray(longitude, dtype=float)
+    valid = ~np.isnan(latitude) & ~np.isnan(longitude)
+    latitude, longitude = latitude[valid], longitude[valid]
+    if len(latitude) == 0:
+        return pd.DataFrame({'cell_lat': [], 'cell_lon': [], 'count': np.zeros(0, dtype=np.int64)})
+    dlat = cell_km / KM_PER_DEGREE
+    middle = (latitude.min() + latitude.max()) / 2
+    dlon = min(dlat / max(math.cos(math.radians(middle)), 1e-6), 360.0)
+    lat_cells = np.floor((latitude + 90) / dlat).astype(np.int64)
+    lon_cells = np.floor((longitude + 180) / dlon).astype(np.int64)
+    width = lon_cells.max() + 1
+    cells, counts = np.unique(lat_cells * width + lon_cells, return_counts=True)
+    lat_cells, lon_cells = np.divmod(cells, width)
+    order = np.argsort(-counts, kind='stable')
+    return pd.DataFrame({
+        'cell_lat': (lat_cells[order] + 0.5) * dlat - 90,
+        'cell_lon': (lon_cells[order] + 0.5) * dlon - 180,
+        'count': counts[order],
+    })
+
+
+def geometry_rings(geojson):
+    """ Returns the rings of a GeoJSON Polygon or MultiPolygon as (n, 2) arrays of [lon, lat] """
+    if geojson['type'] == 'Polygon':
+        polygons = [geojson['coordinates']]
+    elif geojson['type'] == 'MultiPolygon':
+        polygons = geojson['coordinates']
+    else:
+        raise ValueError(f"Unsupported geometry type {geojson['type']}")
+    return [np.asarray(ring, dtype=float)[:, :2] for polygon in polygons for ring in polygon]
+
+
+def geometry_bbox(geojson):
+    """ Returns (min lat, min lon, max lat, max lon) of a GeoJSON Polygon or MultiPolygon """
+    points = np.concatenate(geometry_rings(geojson))
+    return points[:, 1].min(), points[:, 0].min(), points[:, 1].max(), points[:, 0].max()
+
+
+def points_in_geometry(latitude, longitude, geojson):
+    """ Returns a boolean mask of the points inside a GeoJSON Polygon or MultiPolygon (holes excluded).
+
+    Even-odd ray casting, with the points sorted by latitude so each edge is only
+    tested against the points in its latitude band. A horizontal line crosses few
+    edges, so the work is about the number of points times the crossings per line. """
+    latitude = np.asarray(latitude, dtype=float)
+    longitude = np.asarray(longitude, dtype=float)
+    order = np.argsort(latitude, kind='stable')
+    lat, lon = latitude[order], longitude[order]
+    inside = np.zeros(len(lat), dtype=bool)
+    for ring in geometry_rings(geojson):
+        x0, y0 = ring[:-1, 0], ring[:-1, 1]
+        x1, y1 = ring[1:, 0], ring[1:, 1]
+        starts = np.searchsorted(lat, np.minimum(y0, y1), side='left')
+        ends = np.searchsorted(lat, np.maximum(y0, y1), side='left')
+        for i in np.flatnonzero(ends > starts):
+            band = slice(starts[i], ends[i])
+            # The point's ray east crosses this edge if the edge is east of it at the point's latitude
+            x_cross = x0[i] + (lat[band] - y0[i]) * (x1[i] - x0[i]) / (y1[i] - y0[i])
+            inside[band] ^= lon[band] < x_cross
+    mask = np.zeros(len(lat), dtype=bool)
+    mask[order] = inside
+    return mask
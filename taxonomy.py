@@ -0,0 +1,473 @@
+# Local index of iNaturalist taxa for offline name search and ancestry checks
+#
+#   python taxonomy.py taxa.csv   # load the taxa file from the iNaturalist open data export
+
+import argparse
+import bisect
+import csv
+import io
+import os
+import sqlite3
+import threading
+from collections import Counter
+
+import numpy as np
+import pyarrow as pa
+import requests
+
+from inat_cache import CACHE_DIR
+from inat_client import get_json
+
+SEARCH_LIMIT = 30  # same as a page of /taxa results
+FUZZY_MIN_SCORE = 0.4  # trigram similarity below which a name isn't offered as a match
+PREFIX_CANDIDATES = 2000  # prefix matches ranked before giving up on the rest
+TAXA_PER_REQUEST = 30  # ids the API accepts in one /taxa/{ids} call
+INCREMENTAL_ROWS = 10000  # adds larger than this rebuild the in-memory index rather than update it
+MAX_PENDING = 50000  # taxa placed by walking up to a numbered ancestor before the intervals are renumbered
+MAX_NEW_KEYS = 20000  # name keys held in the small sorted list before it is merged into the main one
+
+# Taxa that give their name to every descendant's iconic_taxon_name, most specific last when nested
+ICONIC_TAXA = {
+    48222: "Chromista", 47686: "Protozoa", 47170: "Fungi", 47126: "Plantae", 1: "Animalia",
+    47115: "Mollusca", 47119: "Arachnida", 47158: "Insecta", 47178: "Actinopterygii",
+    20978: "Amphibia", 26036: "Reptilia", 3: "Aves", 40151: "Mammalia",
+}
+
+COLUMNS = ['id', 'ancestry', 'name', 'common_name', 'rank', 'rank_level', 'iconic_taxon_name',
+           'is_active', 'extinct', 'observations_count']
+
+
+class TaxonomyIndex:
+    """ Taxa seen in API responses or loaded from a bulk file, kept in SQLite and searched in memory.
+
+    Every taxon gets a nested-set interval (lft, rgt) over the tree its ancestry
+    strings describe, so "is X a descendant of Y" is two comparisons. Names, both
+    scientific and common, are searchable by word prefix, with a trigram fuzzy
+    match as a fallback.
+
+    The in-memory index is built once. Small adds (such as API results) update it
+    in place: new names go to a small sorted list searched beside the main one,
+    and new taxa are placed by walking up to their first numbered ancestor until
+    enough of them pile up to be worth renumbering the tree.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            path = os.path.join(CACHE_DIR, "taxonomy.sqlite")
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS taxa ("
+            "id INTEGER PRIMARY KEY, ancestry TEXT, name TEXT, common_name TEXT, rank TEXT, rank_level REAL, "
+            "iconic_taxon_name TEXT, is_active INTEGER, extinct INTEGER, observations_count INTEGER)"
+        )
+        self.conn.commit()
+        self.stale = True  # the whole in-memory index needs building from the table
+        self.tree_stale = False  # only the intervals need renumbering
+
+    def add(self, taxa):
+        """ Stores taxa in the shape the API returns them, keeping known values the new records lack """
+        rows = []
+        for taxon in taxa:
+            if not taxon or taxon.get('id') is None:
+                continue
+            ancestry = taxon.get('ancestry')
+            if ancestry is None and taxon.get('ancestor_ids'):
+                ancestry = "/".join(str(i) for i in taxon['ancestor_ids'] if i != taxon['id'])
+            rows.append((
+                taxon['id'], ancestry, taxon.get('name'), taxon.get('preferred_common_name'),
+                taxon.get('rank'), taxon.get('rank_level'), taxon.get('iconic_taxon_name'),
+                taxon.get('is_active'), taxon.get('extinct'), taxon.get('observations_count'),
+            ))
+        self.add_rows(rows)
+
+    def add_rows(self, rows):
+        """ Upserts rows of COLUMNS values; None never overwrites a stored value """
+        if not rows:
+            return
+        updates = ", ".join(f"{col} = COALESCE(excluded.{col}, taxa.{col})" for col in COLUMNS[1:])
+        with self.lock:
+            self.conn.executemany(
+                f"INSERT INTO taxa VALUES ({', '.join('?' * len(COLUMNS))}) ON CONFLICT(id) DO UPDATE SET {updates}",
+                rows,
+            )
+            self.conn.commit()
+            if self.stale or len(rows) > INCREMENTAL_ROWS:
+                self.stale = True
+            else:
+                self.update(rows)
+
+    def update(self, rows):
+        """ Applies upserted rows to the built in-memory index """
+        for row in rows:
+            taxon_id = row[0]
+            taxon = self.taxa.get(taxon_id)
+            if taxon is None:
+                taxon = self.taxa[taxon_id] = dict.fromkeys(COLUMNS, None)
+            old_names = (taxon['name'], taxon['common_name'])
+            for col, value in zip(COLUMNS, row):
+                if value is not None:
+                    taxon[col] = value
+            self.place(taxon_id, taxon['ancestry'])
+            if taxon['iconic_taxon_name'] is None:
+                taxon['iconic_taxon_name'] = self.iconic_name(taxon_id, self.parents)
+            for name in (taxon['name'], taxon['common_name']):
+                if name and name not in old_names:
+                    self.add_name(name, taxon_id)
+        if len(self.new_keys) > MAX_NEW_KEYS:
+            self.merge_keys()
+        if len(self.pending) > MAX_PENDING:
+            self.tree_stale = True
+
+    def place(self, taxon_id, ancestry):
+        """ Records the parents an ancestry path gives, the first path seen for a node winning as in build_parents """
+        path = [int(i) for i in ancestry.split("/")] if ancestry else []
+        path.append(taxon_id)
+        for parent, child in zip([None] + path[:-1], path):
+            if child in self.parents and (self.parents[child] is not None or parent is None):
+                continue
+            self.parents[child] = parent
+            if child in self.intervals:
+                # A numbered root gained a parent, so the numbering no longer nests
+                self.tree_stale = True
+            else:
+                self.pending.add(child)
+
+    def load_open_data(self, path, batch_size=50000):
+        """ Loads taxa.csv from the iNaturalist open data export (tab separated:
+        taxon_id, ancestry, rank_level, rank, name, active), gzipped or not. It has no common names. """
+        with io.TextIOWrapper(pa.input_stream(path, compression='detect'), encoding='utf-8', newline='') as f:
+            reader = csv.DictReader(f, delimiter='\t')
+            batch = []
+            for record in reader:
+                batch.append((
+                    int(record['taxon_id']), record['ancestry'] or None, record['name'], None, record['rank'],
+                    float(record['rank_level']) if record['rank_level'] else None, None,
+                    record['active'].lower() == 'true', None, None,
+                ))
+                if len(batch) >= batch_size:
+                    self.add_rows(batch)
+                    batch = []
+            self.add_rows(batch)
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM taxa").fetchone()[0]
+
+    def build(self):
+        """ Builds the in-memory search structures and ancestry intervals, or renumbers the
+        intervals if enough taxa were added since """
+        with self.lock:
+            if self.stale:
+                rows = self.conn.execute(f"SELECT {', '.join(COLUMNS)} FROM taxa").fetchall()
+                self.taxa = {row[0]: dict(zip(COLUMNS, row)) for row in rows}
+                self.build_parents()
+                self.build_intervals()
+                self.build_names()
+                self.stale = False
+            elif self.tree_stale:
+                self.build_intervals()
+
+    def build_parents(self):
+        # Every id named in an ancestry is a node, even if its own record was never stored
+        parents = {}
+        for taxon_id, taxon in self.taxa.items():
+            path = [int(i) for i in taxon['ancestry'].split("/")] if taxon['ancestry'] else []
+            path.append(taxon_id)
+            for parent, child in zip([None] + path[:-1], path):
+                if parents.get(child) is None:
+                    parents[child] = parent
+        self.parents = parents
+
+    def build_intervals(self):
+        parents = self.parents
+        children = {}
+        for child, parent in parents.items():
+            children.setdefault(parent, []).append(child)
+
+        intervals = {}
+        counter = 0
+        stack = [(root, False) for root in sorted(children.get(None, []), reverse=True)]
+        while stack:
+            node, done = stack.pop()
+            if done:
+                intervals[node] = (intervals[node][0], counter - 1)
+                continue
+            intervals[node] = (counter, None)
+            counter += 1
+            stack.append((node, True))
+            stack.extend((child, False) for child in sorted(children.get(node, []), reverse=True))
+
+        self.interval_ids = np.array(sorted(intervals), dtype=np.int64)
+        self.interval_lft = np.array([intervals[i][0] for i in self.interval_ids], dtype=np.int64)
+        self.intervals = intervals
+        self.pending = set()  # nodes added since the intervals were numbered
+        self.tree_stale = False
+
+        for taxon_id, taxon in self.taxa.items():
+            if taxon['iconic_taxon_name'] is None:
+                taxon['iconic_taxon_name'] = self.iconic_name(taxon_id, parents)
+        self.taxon_ids = np.array(sorted(self.taxa), dtype=np.int64)
+        self.taxon_iconic = np.array([self.taxa[i]['iconic_taxon_name'] for i in self.taxon_ids], dtype=object)
+
+    def iconic_name(self, taxon_id, parents):
+        node = taxon_id
+        while node is not None:
+            if node in ICONIC_TAXA:
+                return ICONIC_TAXA[node]
+            node = parents.get(node)
+        return None
+
+    def build_names(self):
+        # Every word start of every name is a key, so "rattlesnake" finds "Western Diamondback Rattlesnake"
+        keys = []
+        self.trigrams = {}
+        self.names = []  # (name as stored, taxon id)
+        for taxon_id, taxon in self.taxa.items():
+            for name in (taxon['name'], taxon['common_name']):
+                if not name:
+                    continue
+                entry = len(self.names)
+                self.names.append((name, taxon_id))
+                lower = name.lower()
+                words = lower.split(" ")
+                for i in range(len(words)):
+                    keys.append((" ".join(words[i:]), entry))
+                for trigram in trigrams(lower):
+                    self.trigrams.setdefault(trigram, []).append(entry)
+        keys.sort()
+        self.keys = [key for key, _ in keys]
+        self.key_entries = [entry for _, entry in keys]
+        self.new_keys = []  # (key, entry) pairs added since, sorted
+
+    def add_name(self, name, taxon_id):
+        entry = len(self.names)
+        self.names.append((name, taxon_id))
+        lower = name.lower()
+        words = lower.split(" ")
+        for i in range(len(words)):
+            bisect.insort(self.new_keys, (" ".join(words[i:]), entry))
+        for trigram in trigrams(lower):
+            self.trigrams.setdefault(trigram, []).append(entry)
+
+    def merge_keys(self):
+        keys = sorted(list(zip(self.keys, self.key_entries)) + self.new_keys)
+        self.keys = [key for key, _ in keys]
+        self.key_entries = [entry for _, entry in keys]
+        self.new_keys = []
+
+    def prefix_entries(self, query):
+        """ Yields (key, name entry) for keys starting with query from the main and new key lists """
+        start = bisect.bisect_left(self.keys, query)
+        for key, entry in zip(self.keys[start:start + PREFIX_CANDIDATES], self.key_entries[start:start + PREFIX_CANDIDATES]):
+            if not key.startswith(query):
+                break
+            yield key, entry
+        start = bisect.bisect_left(self.new_keys, (query,))
+        for key, entry in self.new_keys[start:start + PREFIX_CANDIDATES]:
+            if not key.startswith(query):
+                break
+            yield key, entry
+
+    def current_name(self, entry):
+        """ Returns (name, taxon id) of a name entry, or None if the taxon has since been renamed """
+        name, taxon_id = self.names[entry]
+        taxon = self.taxa[taxon_id]
+        if name != taxon['name'] and name != taxon['common_name']:
+            return None
+        return name, taxon_id
+
+    def search(self, query, rank=None, iconic_taxon_name=None, limit=SEARCH_LIMIT, fuzzy=True):
+        """ Returns taxa whose names start with (or, failing that, resemble) query, best first,
+        as dicts in the shape of GetTaxonID results """
+        # Readers hold the lock too, since add() from a concurrent tool call updates the index in place
+        with self.lock:
+            self.build()
+            query = query.strip().lower()
+            if not query:
+                return []
+            matches = {}  # taxon id -> (rank key, matched name)
+            for key, entry in self.prefix_entries(query):
+                if self.current_name(entry) is None:
+                    continue
+                name, taxon_id = self.names[entry]
+                # Exact names first, then names that start with the query, then later words that do
+                score = 0 if name.lower() == query else 1 if name.lower().startswith(query) else 2
+                if taxon_id not in matches or score < matches[taxon_id][0]:
+                    matches[taxon_id] = (score, name)
+            if not matches and fuzzy:
+                for entry, similarity in self.fuzzy_entries(query):
+                    if self.current_name(entry) is None:
+                        continue
+                    name, taxon_id = self.names[entry]
+                    if taxon_id not in matches:
+                        matches[taxon_id] = (3 - similarity, name)
+
+            results = []
+            for taxon_id, (score, name) in matches.items():
+                taxon = self.taxa[taxon_id]
+                if taxon['is_active'] == 0 or taxon['extinct']:
+                    continue
+                if rank is not None and taxon['rank'] != rank:
+                    continue
+                if iconic_taxon_name is not None and taxon['iconic_taxon_name'] != iconic_taxon_name:
+                    continue
+                results.append((score, -(taxon['observations_count'] or 0), taxon_id, name))
+            results.sort()
+            return [self.result(taxon_id, name) for _, _, taxon_id, name in results[:limit]]
+
+    def fuzzy_entries(self, query):
+        """ Yields (name entry, similarity) for names sharing enough trigrams with query, most similar first """
+        query_trigrams = trigrams(query)
+        shared = Counter()
+        for trigram in query_trigrams:
+            shared.update(self.trigrams.get(trigram, ()))
+        scored = []
+        for entry, count in shared.items():
+            similarity = 2 * count / (len(query_trigrams) + len(trigrams(self.names[entry][0].lower())))
+            if similarity >= FUZZY_MIN_SCORE:
+                scored.append((similarity, entry))
+        scored.sort(reverse=True)
+        return [(entry, similarity) for similarity, entry in scored[:SEARCH_LIMIT]]
+
+    def result(self, taxon_id, matched_term):
+        taxon = self.taxa[taxon_id]
+        return {
+            'id': taxon_id,
+            'rank': taxon['rank'],
+            'name': taxon['name'],
+            'observations_count': taxon['observations_count'],
+            'matched_term': matched_term,
+            'iconic_taxon_name': taxon['iconic_taxon_name'],
+            'preferred_common_name': taxon['common_name'],
+        }
+
+    def lineage(self, taxon_id):
+        """ Returns (the nodes added since numbering on taxon_id's path up, taxon_id first,
+        the lft of the first numbered node on it or None) """
+        chain = []
+        node = taxon_id
+        while node is not None and node not in self.intervals:
+            if node not in self.parents:
+                return chain, None
+            chain.append(node)
+            node = self.parents[node]
+        return chain, self.intervals[node][0] if node is not None else None
+
+    def is_descendant(self, taxon_id, ancestor_id):
+        """ True if taxon_id is ancestor_id or below it in the tree """
+        with self.lock:
+            self.build()
+            chain, node_lft = self.lineage(taxon_id)
+            # Numbered nodes never gain new ancestors, so a new ancestor is always on the new part of the path
+            if ancestor_id in chain:
+                return True
+            if ancestor_id not in self.intervals or node_lft is None:
+                return False
+            lft, rgt = self.intervals[ancestor_id]
+            return lft <= node_lft <= rgt
+
+    def descendant_mask(self, taxon_ids, ancestor_id):
+        """ Vectorized is_descendant over an array of taxon ids (NaN for missing). Unknown ids never match """
+        with self.lock:
+            self.build()
+            ids = np.nan_to_num(np.asarray(taxon_ids, dtype=float), nan=-1).astype(np.int64)
+            mask = np.zeros(len(ids), dtype=bool)
+            if ancestor_id in self.intervals and len(self.interval_ids) > 0:
+                lft, rgt = self.intervals[ancestor_id]
+                pos = np.minimum(np.searchsorted(self.interval_ids, ids), len(self.interval_ids) - 1)
+                node_lft = self.interval_lft[pos]
+                mask = (self.interval_ids[pos] == ids) & (node_lft >= lft) & (node_lft <= rgt)
+            if self.pending:
+                # Taxa added since the numbering are checked one distinct id at a time
+                new_ids = np.intersect1d(ids, np.fromiter(self.pending, dtype=np.int64, count=len(self.pending)))
+                for taxon_id in new_ids:
+                    if self.is_descendant(int(taxon_id), ancestor_id):
+                        mask |= ids == taxon_id
+            return mask
+
+    def descendant_ids(self, ancestor_id):
+        """ Returns the ids of ancestor_id and every taxon below it, as a numpy array """
+        with self.lock:
+            self.build()
+            ids = np.zeros(0, dtype=np.int64)
+            if ancestor_id in self.intervals:
+                lft, rgt = self.intervals[ancestor_id]
+                ids = self.interval_ids[(self.interval_lft >= lft) & (self.interval_lft <= rgt)]
+            new_ids = [taxon_id for taxon_id in self.pending if self.is_descendant(taxon_id, ancestor_id)]
+            return np.concatenate([ids, np.array(new_ids, dtype=np.int64)])
+
+    def iconic_names(self, taxon_ids):
+        """ Vectorized iconic_taxon_name over an array of taxon ids (NaN for missing), None where unknown """
+        with self.lock:
+            self.build()
+            ids = np.nan_to_num(np.asarray(taxon_ids, dtype=float), nan=-1).astype(np.int64)
+            names = np.full(len(ids), None, dtype=object)
+            found = np.zeros(len(ids), dtype=bool)
+            if len(self.taxon_ids) > 0:
+                pos = np.minimum(np.searchsorted(self.taxon_ids, ids), len(self.taxon_ids) - 1)
+                found = self.taxon_ids[pos] == ids
+                names[found] = self.taxon_iconic[pos[found]]
+            if self.pending:
+                for taxon_id in np.intersect1d(ids[~found], np.fromiter(self.pending, dtype=np.int64, count=len(self.pending))):
+                    if taxon_id in self.taxa:
+                        names[ids == taxon_id] = self.taxa[taxon_id]['iconic_taxon_name']
+            return names
+
+    def iconic_groups_under(self, ancestor_id):
+        """ Returns the iconic_taxon_names that ancestor_id and its descendants can have.
+        None stands for taxa outside every iconic group """
+        with self.lock:
+            self.build()
+            groups = {self.iconic_name(ancestor_id, self.parents)}
+            groups.update(name for taxon_id, name in ICONIC_TAXA.items() if self.is_descendant(taxon_id, ancestor_id))
+            return groups
+
+    def missing(self, taxon_ids):
+        """ Returns the ids among taxon_ids that have no place in the tree yet """
+        with self.lock:
+            self.build()
+            return [int(i) for i in taxon_ids if int(i) not in self.parents]
+
+    def fetch(self, taxon_ids):
+        """ Adds any of taxon_ids the index doesn't know yet, looked up through the API.
+        Lookups that fail are skipped, so those taxa simply stay unknown """
+        missing = self.missing(taxon_ids)
+        for i in range(0, len(missing), TAXA_PER_REQUEST):
+            batch = missing[i:i + TAXA_PER_REQUEST]
+            try:
+                self.add(get_json('/taxa/' + ",".join(str(taxon_id) for taxon_id in batch)).get('results', []))
+            except (requests.exceptions.RequestException, ValueError):
+                return
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """ Returns the process-wide taxonomy index, opening it on first use """
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = TaxonomyIndex()
+        return _index
+
+
+def main(args):
+    index = get_index()
+    index.load_open_data(args.taxa_file)
+    print(f"Taxonomy index at {index.path} now holds {len(index)} taxa")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the iNaturalist open data taxa file into the local taxonomy index.")
+    parser.add_argument('taxa_file', type=str, help='taxa.csv from the open data export')
+    main(parser.parse_args())
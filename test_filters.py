@@ -0,0 +1,32 @@
+import pandas as pd
+import pytest
+
+from data_objects import DataFrame
+from nate_tools import AggregateDF, ReadDF, filter_mask
+
+
+def category_frame():
+    data = pd.DataFrame({
+        'quality_grade': pd.Categorical(['research', 'casual', None, 'needs_id']),
+        'count': [1, 2, 3, 4],
+    })
+    return DataFrame("obs", data)
+
+
+def test_ordered_comparison_on_categorical():
+    DF = category_frame()
+    assert filter_mask(DF, DF.data, [["quality_grade", ">", "needs_id"]]).tolist() == [True, False, False, False]
+    assert filter_mask(DF, DF.data, [["quality_grade", "<=", "needs_id"]]).tolist() == [False, True, False, True]
+    assert filter_mask(DF, DF.data, [["quality_grade", "!=", "casual"]]).tolist() == [True, False, False, True]
+
+    result, _ = ReadDF.call({DF.name: DF}, df=DF.name, query_tuples=[["quality_grade", ">", "a"]])
+    assert "research" in result and "casual" in result
+
+    result, _ = AggregateDF.call({DF.name: DF}, df=DF.name, dataframe_name="n", query_tuples=[["quality_grade", ">=", "needs_id"]])
+    assert result.splitlines()[-1].split() == ["0", "2"]
+
+
+def test_uncomparable_value_is_a_value_error():
+    DF = DataFrame("mixed", pd.DataFrame({'value': ["a", 1, None]}))
+    with pytest.raises(ValueError):
+        filter_mask(DF, DF.data, [["value", ">", "b"]])
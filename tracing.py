@@ -0,0 +1,176 @@
+# Structured timing spans for the agent loop, written as JSON lines
+
+import contextvars
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+
+TRACE_PATH = os.getenv("NATE_TRACE")  # file spans are appended to; tracing is off when unset
+PROFILE = os.getenv("NATE_PROFILE")  # "cpu" (cProfile) or "memory" (tracemalloc), applied to each tool call
+PROFILES = ("cpu", "memory")
+TOP_ALLOCATIONS = 5
+
+_current = contextvars.ContextVar("nate_span", default=None)
+_write_lock = threading.Lock()
+_profile_lock = threading.Lock()  # one profiler at a time; concurrent tool calls go unprofiled
+_file = None
+
+
+def configure(path=None, profile=None):
+    """ Starts writing spans to path, optionally profiling every tool call """
+    global TRACE_PATH, PROFILE, _file
+    assert profile is None or profile in PROFILES, f"profile must be one of {PROFILES}"
+    with _write_lock:
+        if _file is not None:
+            _file.close()
+            _file = None
+        TRACE_PATH = path
+        PROFILE = profile
+
+
+def enabled():
+    return TRACE_PATH is not None
+
+
+class Span:
+    """ One timed operation. Attributes set on it are written with its timing when it ends """
+
+    def __init__(self, name, parent=None, attrs=None):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.trace_id = parent.trace_id if parent is not None else self.span_id
+        self.attrs = dict(attrs or {})
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add(self, key, amount=1):
+        self.attrs[key] = self.attrs.get(key, 0) + amount
+
+
+class NullSpan:
+    """ Stand-in returned while tracing is off, so call sites never need to check """
+
+    span_id = trace_id = None
+
+    def set(self, **attrs):
+        pass
+
+    def add(self, key, amount=1):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+def current():
+    """ Returns the innermost open span, to attach attributes to it """
+    span_ = _current.get()
+    return span_ if span_ is not None else NULL_SPAN
+
+
+@contextmanager
+def span(name, parent=None, **attrs):
+    """ Times the enclosed block as a child of the current span (or of parent) """
+    if not enabled():
+        yield NULL_SPAN
+        return
+    parent = parent if parent is not None else _current.get()
+    span_ = Span(name, None if isinstance(parent, NullSpan) else parent, attrs)
+    token = _current.set(span_)
+    start = time.time()
+    start_counter = time.perf_counter()
+    try:
+        yield span_
+    except BaseException as e:
+        span_.set(error=f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        _current.reset(token)
+        write({
+            "trace_id": span_.trace_id,
+            "span_id": span_.span_id,
+            "parent_id": span_.parent_id,
+            "name": name,
+            "start": start,
+            "duration_ms": round((time.perf_counter() - start_counter) * 1000, 3),
+            "thread": threading.current_thread().name,
+            **span_.attrs,
+        })
+
+
+def propagate(fn, parent=None):
+    """ Wraps fn so spans it opens on another thread nest under the current span """
+    parent = parent if parent is not None else _current.get()
+    if isinstance(parent, NullSpan):
+        parent = None
+
+    def run(*args, **kwargs):
+        token = _current.set(parent)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return run
+
+
+def write(record):
+    global _file
+    line = json.dumps(record, default=str) + "\n"
+    with _write_lock:
+        if TRACE_PATH is None:
+            return
+        if _file is None:
+            _file = open(TRACE_PATH, 'a')
+        _file.write(line)
+        _file.flush()
+
+
+@contextmanager
+def profiled(span_):
+    """ Runs the enclosed block under cProfile or tracemalloc if NATE_PROFILE asks for it,
+    adding the results to span_. cProfile stats are saved next to the trace file. """
+    if not enabled() or PROFILE not in PROFILES or not _profile_lock.acquire(blocking=False):
+        yield
+        return
+    try:
+        if PROFILE == "cpu":
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                profile_dir = os.path.splitext(TRACE_PATH)[0] + "_profiles"
+                os.makedirs(profile_dir, exist_ok=True)
+                path = os.path.join(profile_dir, f"{span_.span_id}.prof")
+                profiler.dump_stats(path)
+                span_.set(profile=path)
+        else:
+            started = not tracemalloc.is_tracing()
+            if started:
+                tracemalloc.start()
+            # tracemalloc counts every thread, so concurrent work shows up here too
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            first = tracemalloc.take_snapshot()
+            try:
+                yield
+            finally:
+                current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+                top = tracemalloc.take_snapshot().compare_to(first, 'lineno')[:TOP_ALLOCATIONS]
+                span_.set(
+                    alloc_bytes=current_bytes - before,
+                    peak_alloc_bytes=peak_bytes - before,
+                    top_allocations=[str(stat) for stat in top],
+                )
+                if started:
+                    tracemalloc.stop()
+    finally:
+        _profile_lock.release()